@@ -0,0 +1,97 @@
+import os, csv, json, time, argparse, traceback
+from concurrent.futures import ProcessPoolExecutor
+import helpers
+from helpers import fiat_currencies, prefetch_rates
+
+root = os.path.dirname(os.path.abspath(__file__))
+crypto_exchanges = ['binance', 'coinbase', 'kraken', 'bittrex', 'nexo']
+calculators = {}
+
+def get_calculator(source):
+    if source not in calculators:
+        if source in ['etoro', 'mintos', 'crypto']:
+            calculators[source] = helpers.load_script(os.path.join(root, source, 'calculate_tax.py'), f'{source}_calculate_tax')
+        elif source in crypto_exchanges:
+            calculators[source] = helpers.load_script(os.path.join(root, 'crypto', source + '.py'), source)
+        else:
+            raise Exception(f'Unknown source {source}')
+    return calculators[source]
+
+def read_manifest(path):
+    # json list or csv with source,file,year columns, relative files are resolved against the manifest folder
+    with open(path, 'r', encoding='utf-8') as f:
+        jobs = json.load(f) if path.endswith('.json') else list(csv.DictReader(f))
+    folder = os.path.dirname(os.path.abspath(path))
+    return [{'source': x['source'], 'file': os.path.join(folder, x['file']), 'year': int(x['year'])} for x in jobs]
+
+def warm_caches(jobs):
+    pairs = set()
+    for job in jobs:
+        currencies = ['USD'] if job['source'] == 'etoro' else fiat_currencies
+        pairs |= set([(currency, year) for currency in currencies for year in [job['year'] - 1, job['year']]])
+    prefetch_rates(pairs)
+
+    instruments = None
+    if any(job['source'] == 'etoro' for job in jobs):
+        get_calculator('etoro')
+        import mapping
+        mapping.load_instruments()
+        instruments = (mapping.instruments_by_full_symbol, mapping.instruments_by_display_name)
+    return (helpers.rates_cache, instruments)
+
+def init_worker(rates, instruments):
+    helpers.use_rates_snapshot(rates)
+    if instruments is not None:
+        get_calculator('etoro')
+        import mapping
+        mapping.instruments_by_full_symbol, mapping.instruments_by_display_name = instruments
+
+def calculate(job):
+    calculator = get_calculator(job['source'])
+    if job['source'] == 'etoro':
+        calculator.year = job['year']
+        return calculator.calculate(job['file'])
+    elif job['source'] == 'mintos':
+        przychod, dochod, cost, total_tax, tax_paid_abroad, tax_to_pay = calculator.calculate_tax(job['file'])
+        return {'przychod': przychod, 'dochod': dochod, 'koszt': cost, 'podatek': total_tax, 'podatek_zaplacony': tax_paid_abroad, 'podatek_do_zaplaty': tax_to_pay}
+    elif job['source'] == 'crypto':
+        return calculator.calculate(job['file'])
+    else:
+        exchange_name, przychod, koszt, fiat_staking = calculator.calculate_tax(job['file'])
+        if exchange_name is None:
+            raise Exception(f'Missing file {job["file"]}')
+        return {'exchange': exchange_name, 'przychod': przychod, 'koszt': koszt, 'fiat_staking': fiat_staking}
+
+def run_job(job):
+    start = time.perf_counter()
+    try:
+        record = {**job, 'status': 'ok', 'result': calculate(job)}
+    except BaseException as e:
+        # mintos calls exit() on unknown transaction types
+        record = {**job, 'status': 'error', 'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()}
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs many statements in parallel')
+    parser.add_argument('manifest', help='json or csv file with source,file,year jobs. source is etoro, mintos, crypto (file is a folder) or one of the crypto exchanges')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', help='write the results to a file instead of stdout')
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest)
+    rates, instruments = warm_caches(jobs)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(rates, instruments)) as executor:
+        results = list(executor.map(run_job, jobs))
+
+    output = json.dumps(results, indent=2, ensure_ascii=False, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    if any(x['status'] != 'ok' for x in results):
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import os, sys, json, time, shutil, argparse, tempfile
+from decimal import Decimal
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+work_dir = tempfile.mkdtemp(prefix='tax-fx-modes-')
+# everything runs offline against generated fixtures, never against the real rate store
+os.environ['TAX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+os.environ['TAX_HTTP_MODE'] = 'replay'
+os.environ['TAX_HTTP_FIXTURES'] = os.path.join(work_dir, 'http')
+sys.path.append(root)
+
+import helpers, profiling, generators
+
+mintos = helpers.load_script(os.path.join(root, 'mintos', 'calculate_tax.py'), 'mintos_calculate_tax')
+sources = {
+    'kraken': (helpers.load_script(os.path.join(root, 'crypto', 'kraken.py'), 'kraken'), generators.kraken_xlsx, 'kraken.xlsx'),
+    'binance': (helpers.load_script(os.path.join(root, 'crypto', 'binance.py'), 'binance'), generators.binance_csv, 'binance.csv'),
+    'mintos': (mintos, generators.mintos_export, 'mintos.xlsx')
+}
+
+class RowTotals:
+    # the baseline, what the calculators summed before FxTotals: every row converted and rounded on its own
+    def __init__(self, dec_places=None):
+        self.dec_places = dec_places
+        self.totals = {}
+
+    def add(self, category, asOfDate, amount, currency, sign=1):
+        pln = helpers.convert_rate(asOfDate, amount, currency, self.dec_places)
+        self.totals[category] = self.totals.get(category, Decimal(0)) + sign * pln
+        return pln
+
+    def add_many(self, category, dates, amounts, currency, sign=1):
+        for asOfDate, amount in zip(dates, amounts):
+            self.add(category, asOfDate, amount, currency, sign)
+
+    def get(self, category):
+        return self.totals.get(category, Decimal(0))
+
+def calculate(source, path, totals, mode):
+    # (result, seconds, fx lookups)
+    module, _, _ = sources[source]
+    module.FxTotals = totals
+    helpers.fx_aggregation = mode
+    profiling.counters.clear()
+    start = time.perf_counter()
+    result = module.calculate_statement(path) if source == 'mintos' else module.calculate_tax(path)
+    return (result, round(time.perf_counter() - start, 6), profiling.counters.get('fx_lookups', 0))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the fx_aggregation modes with the per row baseline on generated exports')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated number of rows')
+    parser.add_argument('--year', type=int, default=2024)
+    parser.add_argument('--seeds', type=int, default=3)
+    args = parser.parse_args()
+
+    generators.write_http_fixtures([args.year - 1, args.year])
+    profiling.enabled = True
+    results = []
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for seed in range(args.seeds):
+            for source, (module, generator, file_name) in sources.items():
+                path = os.path.join(work_dir, f'{size}_{seed}_{file_name}')
+                generator(path, size, args.year, seed)
+                expected, _, _ = calculate(source, path, RowTotals, 'rows')
+                outputs = dict([(mode, calculate(source, path, helpers.FxTotals, mode)) for mode in ['rows', 'rates']])
+                # reprs are compared, the figures are printed and 0 is not 0.00
+                results.append({
+                    'source': source,
+                    'size': size,
+                    'seed': seed,
+                    'seconds': dict([(mode, seconds) for mode, (_, seconds, _) in outputs.items()]),
+                    'fx_lookups': dict([(mode, lookups) for mode, (_, _, lookups) in outputs.items()]),
+                    'rates_difference': [str(x - y) for x, y in zip(outputs['rates'][0], expected) if not isinstance(x, str)],
+                    'rows_matches_baseline': repr(outputs['rows'][0]) == repr(expected)
+                })
+
+    print(json.dumps(results, indent=2))
+    shutil.rmtree(work_dir, ignore_errors=True)
+    if not all(x['rows_matches_baseline'] for x in results):
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import os, sys, csv, json, random
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etoro'))
+
+from datetime import datetime, timedelta, date
+from decimal import Decimal
+from openpyxl import Workbook
+from helpers import nbp_url
+from mapping import instruments_link, data_link
+import transport
+
+etoro_date_format = '%d/%m/%Y %H:%M:%S'
+base_rates = {'USD': Decimal('4.0'), 'EUR': Decimal('4.3'), 'GBP': Decimal('5.0')}
+# symbol, display name, exchange id
+stocks = [('AAPL', 'Apple', 4), ('MSFT', 'Microsoft', 4), ('KO', 'Coca-Cola', 5), ('JNJ', 'Johnson & Johnson', 5), ('BMW.DE', 'BMW', 6), ('VOD.L', 'Vodafone', 7)]
+exchanges = [(4, 'NASDAQ'), (5, 'NYSE'), (6, 'Frankfurt'), (7, 'London')]
+
+def random_amount(r, low, high):
+    return Decimal(r.randint(int(low * 100), int(high * 100))) / Decimal(100)
+
+def random_date(r, year):
+    return datetime(year, 1, 2) + timedelta(minutes=r.randint(0, 60 * 24 * 360))
+
+def nbp_rates(currency, year):
+    rates = []
+    day = date(year - 1, 12, 31)
+    while day <= date(year, 12, 31):
+        if day.weekday() < 5 and not (day.month == 1 and day.day == 1):
+            rates.append({'no': f'{day.toordinal()}/A/NBP/{day.year}', 'effectiveDate': day.isoformat(), 'mid': float(base_rates[currency] + Decimal(day.toordinal() % 97) / 1000)})
+        day += timedelta(days=1)
+    return {'table': 'A', 'currency': currency, 'code': currency, 'rates': rates}
+
+def write_http_fixtures(years):
+    for currency in base_rates:
+        for year in years:
+            transport.write_fixture('GET', nbp_url(currency, year), None, 200, {'Content-Type': 'application/json'}, json.dumps(nbp_rates(currency, year)))
+
+    types = {'InstrumentTypes': [{'InstrumentTypeID': 5, 'InstrumentTypeDescription': 'Stocks'}, {'InstrumentTypeID': 10, 'InstrumentTypeDescription': 'Cryptocurrencies'}],
+             'ExchangeInfo': [{'ExchangeID': id, 'ExchangeDescription': name} for id, name in exchanges]}
+    data = [{'IsInternalInstrument': False, 'InstrumentTypeID': 5, 'InstrumentDisplayName': name, 'ExchangeID': exchange, 'SymbolFull': symbol} for symbol, name, exchange in stocks]
+    data += [{'IsInternalInstrument': False, 'InstrumentTypeID': 10, 'InstrumentDisplayName': 'Bitcoin', 'ExchangeID': 8, 'SymbolFull': 'BTC'}]
+    transport.write_fixture('GET', instruments_link, None, 200, {'Content-Type': 'application/json'}, json.dumps(types))
+    transport.write_fixture('GET', data_link, None, 200, {'Content-Type': 'application/json'}, json.dumps({'InstrumentDisplayDatas': data}))
+
+def etoro_statement(path, positions, year, seed=1):
+    r = random.Random(seed)
+    activity = []
+    closed = []
+    dividends = []
+    totals = dict([(x, Decimal(0)) for x in ['stock', 'crypto', 'dividends', 'fees', 'interest']])
+
+    for idx in range(positions):
+        pos_id = str(1000000 + idx)
+        kind = r.choice(['stock', 'stock', 'cfd', 'crypto'])
+        symbol, name, _ = r.choice(stocks)
+        asset_type = {'stock': 'Stocks', 'cfd': 'CFD', 'crypto': 'Crypto'}[kind]
+        details = 'BTC/USD' if kind == 'crypto' else f'{symbol}/USD'
+        open_date = random_date(r, year)
+        close_date = open_date + timedelta(minutes=r.randint(60, 60 * 24 * 60))
+        if close_date.year != year:
+            close_date = datetime(year, 12, 31, 12)
+        amount = random_amount(r, 10, 5000)
+        profit = random_amount(r, -500, 500)
+        if kind != 'cfd' and amount + profit < 0:
+            profit = (-amount / 2).quantize(Decimal('0.01'))
+
+        activity.append([open_date, 'Open Position', details, amount, Decimal(0), pos_id, asset_type])
+        if kind == 'cfd':
+            for day in range(r.randint(0, 10)):
+                fee_date = open_date + timedelta(days=day)
+                if fee_date >= close_date:
+                    break
+                fee = -random_amount(r, 0.01, 2)
+                activity.append([fee_date, 'Overnight fee', 'Daily', fee, Decimal(0), pos_id, asset_type])
+                totals['fees'] += fee
+            if r.random() < 0.1:
+                activity.append([open_date, 'Dividend', details, -random_amount(r, 0.01, 2), Decimal(0), pos_id, asset_type])
+        elif kind == 'stock' and r.random() < 0.3 and open_date + timedelta(days=1) < close_date:
+            payment_date = open_date + timedelta(days=1)
+            net = random_amount(r, 0.5, 30)
+            withholding = round(net * Decimal('0.15') / Decimal('0.85'), 2)
+            activity.append([payment_date, 'Dividend', details, net, Decimal(0), pos_id, asset_type])
+            dividends.append([payment_date.strftime('%d/%m/%Y'), name, float(net), 0, '15%', float(withholding), pos_id, asset_type, ''])
+            totals['dividends'] += net
+
+        activity.append([close_date, 'Position closed', details, amount + profit, profit, pos_id, asset_type])
+        action = 'Buy ' + ('Bitcoin' if kind == 'crypto' else name)
+        closed.append([pos_id, action, 'Long', float(amount), 1, open_date.strftime(etoro_date_format), close_date.strftime(etoro_date_format), 1, 0, float(profit), 'CFD' if kind == 'cfd' else asset_type, '', ''])
+        totals['crypto' if kind == 'crypto' else 'stock'] += profit
+
+    interest = random_amount(r, 1, 10)
+    activity.append([datetime(year, 12, 1), 'Interest Payment', 'Interest', interest, Decimal(0), '1', ''])
+    totals['interest'] += interest
+    activity.sort(key=lambda x: x[0])
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = 'Account Activity'
+    sheet.append(['Date', 'Type', 'Details', 'Amount', 'Units', 'Realized Equity Change', 'Realized Equity', 'Balance', 'Position ID', 'Asset type', 'NWA'])
+    for day, type, details, amount, profit, pos_id, asset_type in activity:
+        sheet.append([day.strftime(etoro_date_format), type, details, float(amount), 1, float(profit), 0, 0, pos_id, asset_type, 0])
+
+    sheet = workbook.create_sheet('Closed Positions')
+    sheet.append(['Position ID', 'Action', 'Long / Short', 'Amount', 'Units', 'Open Date', 'Close Date', 'Leverage', 'Spread Fees (USD)', 'Profit(USD)', 'Type', 'ISIN', 'Notes'])
+    for row in closed:
+        sheet.append(row)
+
+    sheet = workbook.create_sheet('Dividends')
+    sheet.append(['Date of Payment', 'Instrument Name', 'Net Dividend Received (USD)', 'Net Dividend Received (PLN)', 'Withholding Tax Rate (%)', 'Withholding Tax Amount (USD)', 'Position ID', 'Type', 'ISIN'])
+    for row in dividends:
+        sheet.append(row)
+
+    sheet = workbook.create_sheet('Financial Summary')
+    sheet.append(['Name', 'Amount\n in (USD)'])
+    for name, key in [('Stocks (Profit or Loss)', 'stock'), ('Crypto (Profit or Loss)', 'crypto'), ('Stock and ETF Dividends (Profit)', 'dividends'), ('Fees (overnight, withdrawal, admin)', 'fees'), ('Total Interest payments by eToro EU', 'interest')]:
+        sheet.append([name, float(totals[key])])
+    workbook.save(path)
+
+def mintos_export(path, rows, year, seed=2):
+    r = random.Random(seed)
+    types = ['Interest received', 'Interest received', 'Late fees received', 'Tax withholding', 'Mintos Core fee', 'Principal received']
+    workbook = Workbook()
+    for idx in range(2):
+        sheet = workbook.active if idx == 0 else workbook.create_sheet()
+        sheet.title = f'Statement {idx + 1}'
+        sheet.append(['Transaction ID', 'Date', 'Details', 'Turnover', 'Balance', 'Currency', 'Payment Type'])
+        for row in range(rows // 2):
+            type = r.choice(types)
+            amount = random_amount(r, 0.01, 5) * (-1 if type in ['Tax withholding', 'Mintos Core fee'] else 1)
+            details = f'Loan payment ISIN: LV{r.randint(0, max(rows // 10, 1)):010d} (Loan {r.randint(1, 50)}-{r.randint(1, 9)})'
+            sheet.append([row, random_date(r, year).strftime('%Y-%m-%d %H:%M:%S'), details, float(amount), 0, r.choice(['EUR', 'EUR', 'USD']), type])
+    workbook.save(path)
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def binance_csv(path, rows, year, seed=3):
+    r = random.Random(seed)
+    coins = ['BTC', 'ETH', 'BNB', 'ADA', 'DOT', 'SOL', 'XRP', 'DOGE', 'USDT', 'EUR', 'USD']
+    operations = ['Transaction Buy', 'Transaction Sold', 'Transaction Fee', 'Savings Interest', 'Deposit']
+    def row(idx):
+        operation = r.choice(operations)
+        change = random_amount(r, 0.01, 500) * (-1 if operation in ['Transaction Buy', 'Transaction Fee'] else 1)
+        return ['1', random_date(r, year).strftime('%Y-%m-%d %H:%M:%S'), r.choice(['Spot', 'Spot', 'Card', 'Savings']), operation, r.choice(coins), float(change), '"quoted, remark"' if idx % 100 == 0 else '']
+    write_csv(path, ['User_ID', 'UTC_Time', 'Account', 'Operation', 'Coin', 'Change', 'Remark'], [row(idx) for idx in range(rows)])
+
+def coinbase_csv(path, rows, year, seed=4):
+    r = random.Random(seed)
+    def row(idx):
+        return [idx, random_date(r, year).strftime('%Y-%m-%d %H:%M:%S') + ' UTC', r.choice(['Advanced Trade Buy', 'Advanced Trade Sell', 'Send', 'Receive']), r.choice(['USDC', 'USDT']), 1, 'EUR', 1, 1, '€' + str(random_amount(r, 1, 100)), 0, '']
+    write_csv(path, ['ID', 'Timestamp', 'Transaction Type', 'Asset', 'Quantity Transacted', 'Price Currency', 'Price at Transaction', 'Subtotal', 'Total (inclusive of fees and/or spread)', 'Fees and/or Spread', 'Notes'], [row(idx) for idx in range(rows)])
+
+def nexo_csv(path, rows, year, seed=5):
+    r = random.Random(seed)
+    def row(idx):
+        return [f'NXT{idx}', r.choice(['Exchange To Withdraw', 'Exchange Deposited On', 'Interest']), 'EUR', float(random_amount(r, 1, 100)), 'EUR', 1, 1, '', random_date(r, year).strftime('%Y-%m-%d %H:%M:%S')]
+    write_csv(path, ['Transaction', 'Type', 'Input Currency', 'Input Amount', 'Output Currency', 'Output Amount', 'USD Equivalent', 'Details', 'Date / Time (UTC)'], [row(idx) for idx in range(rows)])
+
+def kraken_xlsx(path, rows, year, seed=6):
+    r = random.Random(seed)
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['txid', 'refid', 'time', 'type', 'subtype', 'aclass', 'asset', 'amount', 'fee', 'balance'])
+    for idx in range(rows):
+        type = r.choice(['staking', 'staking', 'staking', 'trade', 'deposit', 'spend', 'receive'])
+        amount = random_amount(r, 0.01, 100)
+        fee = Decimal(0)
+        if type == 'spend':
+            amount = -amount - 1
+        elif type == 'receive':
+            amount = amount + 1
+        elif type == 'trade':
+            amount = amount * r.choice([1, -1])
+            fee = random_amount(r, 0, 1)
+        sheet.append([f'T{idx}', f'R{idx}', random_date(r, year).strftime('%Y-%m-%d %H:%M:%S'), type, '', 'currency', r.choice(['ZEUR', 'EUR.M', 'XXBT', 'DOT.S', 'ETH2.S', 'ADA.S']), float(amount), float(fee), 0])
+    workbook.save(path)
+
+def bittrex_xlsx(path, rows, year, seed=7):
+    r = random.Random(seed)
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['Uuid', 'Exchange', 'TimeStamp', 'OrderType', 'Limit', 'Quantity', 'QuantityRemaining', 'Commission', 'Price', 'PricePerUnit', 'IsConditional', 'Condition', 'ConditionTarget', 'ImmediateOrCancel', 'Closed'])
+    for idx in range(rows):
+        closed = random_date(r, year).strftime('%m/%d/%Y %I:%M:%S %p')
+        sheet.append([f'U{idx}', r.choice(['EUR-BTC', 'EUR-ETH']), '', r.choice(['LIMIT_BUY', 'LIMIT_SELL', 'MARKET_SELL']), 0, 0, 0, float(random_amount(r, 0, 2)), float(random_amount(r, 1, 1000)), 0, False, '', 0, False, closed])
+    workbook.save(path)
+
+crypto_generators = {'binance': ('binance.csv', binance_csv), 'coinbase': ('coinbase.csv', coinbase_csv), 'nexo': ('nexo.csv', nexo_csv), 'kraken': ('kraken.xlsx', kraken_xlsx), 'bittrex': ('bittrex.xlsx', bittrex_xlsx)}
@@ -0,0 +1,115 @@
+import os, sys, json, time, shutil, argparse, tempfile, platform, subprocess
+from decimal import Decimal
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+work_dir = tempfile.mkdtemp(prefix='tax-benchmark-')
+# everything runs offline against generated fixtures, never against the real rate store
+os.environ['TAX_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+os.environ['TAX_HTTP_MODE'] = 'replay'
+os.environ['TAX_HTTP_FIXTURES'] = os.path.join(work_dir, 'http')
+sys.path.append(root)
+
+import helpers, generators
+from openpyxl import load_workbook
+
+etoro = helpers.load_script(os.path.join(root, 'etoro', 'calculate_tax.py'), 'etoro_calculate_tax')
+mintos = helpers.load_script(os.path.join(root, 'mintos', 'calculate_tax.py'), 'mintos_calculate_tax')
+crypto_modules = dict([(name, helpers.load_script(os.path.join(root, 'crypto', name + '.py'), name)) for name in generators.crypto_generators])
+import mapping
+
+def timed(stages, name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    stages[name] = round(time.perf_counter() - start, 6)
+    return result
+
+def reset_caches():
+    helpers.rates_cache.clear()
+    helpers.rate_indexes.clear()
+    if helpers.rates_store is not None:
+        helpers.rates_store.close()
+        helpers.rates_store = None
+    shutil.rmtree(helpers.cache_dir, ignore_errors=True)
+
+def bench_etoro(folder, size, year):
+    path = os.path.join(folder, f'etoro_{size}.xlsx')
+    generators.etoro_statement(path, size, year)
+    etoro.year = year
+    stages = {}
+    statement = timed(stages, 'workbook_load', etoro.Statement, path)
+    entries, transactions, closed_positions = timed(stages, 'parse', etoro.read, statement)
+    dividend_taxes, raw_dividends = timed(stages, 'parse_dividends', etoro.read_dividend_taxes, statement)
+    dates = etoro.entry_dates(entries)
+    timed(stages, 'fx_prefetch', helpers.prefetch_rates, helpers.rate_tables_needed(dates, 'USD'))
+    timed(stages, 'fx_conversion', helpers.convert_rates_batch, dates, [Decimal(1)] * len(dates), 'USD', 2)
+    timed(stages, 'instruments', mapping.load_instruments)
+    dividends = timed(stages, 'aggregation_dividends', etoro.process_dividends, entries, dividend_taxes)
+    timed(stages, 'aggregation_positions', etoro.process_positions, entries, dividends[6], transactions, closed_positions, raw_dividends)
+    timed(stages, 'summary', etoro.read_summary, statement)
+    statement.close()
+    return {'source': 'etoro', 'size': size, 'rows': len(transactions), 'stages': stages}
+
+def bench_mintos(folder, size, year):
+    path = os.path.join(folder, f'mintos_{size}.xlsx')
+    generators.mintos_export(path, size, year)
+    stages = {}
+    transactions, _ = timed(stages, 'parse', mintos.process_transactions, path)
+    reset_caches()
+    timed(stages, 'total', mintos.calculate_tax, path)
+    return {'source': 'mintos', 'size': size, 'rows': size, 'stages': stages}
+
+def read_rows(path, columns):
+    if path.endswith('.csv'):
+        return list(helpers.iter_csv(path, columns))
+    workbook = load_workbook(filename=path, read_only=True)
+    rows = list(helpers.iter_sheet(workbook[workbook.sheetnames[0]], columns))
+    workbook.close()
+    return rows
+
+def bench_crypto(folder, name, size, year):
+    file_name, generator = generators.crypto_generators[name]
+    path = os.path.join(folder, f'{size}_{file_name}')
+    generator(path, size, year)
+    stages = {}
+    timed(stages, 'parse', read_rows, path, getattr(crypto_modules[name], 'columns', None))
+    timed(stages, 'total', crypto_modules[name].calculate_tax, path)
+    return {'source': name, 'size': size, 'rows': size, 'stages': stages}
+
+def code_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the calculators on generated statements')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated number of positions/rows')
+    parser.add_argument('--sources', default='etoro,mintos,binance,coinbase,nexo,kraken,bittrex')
+    parser.add_argument('--year', type=int, default=2024)
+    parser.add_argument('--output', help='write the JSON report to a file instead of stdout')
+    args = parser.parse_args()
+
+    generators.write_http_fixtures([args.year - 1, args.year])
+    results = []
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for source in args.sources.split(','):
+            reset_caches()
+            if source == 'etoro':
+                results.append(bench_etoro(work_dir, size, args.year))
+            elif source == 'mintos':
+                results.append(bench_mintos(work_dir, size, args.year))
+            elif source in generators.crypto_generators:
+                results.append(bench_crypto(work_dir, source, size, args.year))
+            else:
+                raise Exception(f'Unknown source {source}')
+
+    report = {'version': code_version(), 'python': platform.python_version(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
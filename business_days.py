@@ -0,0 +1,136 @@
+from datetime import date, timedelta
+
+# business day calendars, weekends plus the holidays of an exchange. every year is precomputed once as a list of
+# business days and, for each day of the year, the number of business days up to it, so D + N is a lookup
+weekend = (5, 6) # saturday, sunday
+calendars = ['weekdays', 'NBP', 'NYSE']
+# one-off closures the rules below don't know about, add dates here when an exchange announces them
+extra_holidays = {
+    'NYSE': [date(2018, 12, 5), date(2025, 1, 9)],
+}
+tables = {}
+
+def easter(year):
+    # anonymous gregorian algorithm
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+def nth_weekday(year, month, weekday, n):
+    # n-th given weekday of the month, n = -1 is the last one
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+def observed(day):
+    # us holidays falling on a weekend are observed on the closest weekday
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+def polish_holidays(year):
+    # NBP doesn't publish rates on polish public holidays
+    easter_sunday = easter(year)
+    days = [date(year, 1, 1), easter_sunday, easter_sunday + timedelta(days=1), date(year, 5, 1), date(year, 5, 3),
+            easter_sunday + timedelta(days=49), easter_sunday + timedelta(days=60), date(year, 8, 15), date(year, 11, 1),
+            date(year, 11, 11), date(year, 12, 25), date(year, 12, 26)]
+    if year >= 2011:
+        days.append(date(year, 1, 6))
+    if year >= 2025:
+        days.append(date(year, 12, 24))
+    return days
+
+def nyse_holidays(year):
+    days = [nth_weekday(year, 1, 0, 3), nth_weekday(year, 2, 0, 3), easter(year) - timedelta(days=2), nth_weekday(year, 5, 0, -1),
+            observed(date(year, 7, 4)), nth_weekday(year, 9, 0, 1), nth_weekday(year, 11, 3, 4), observed(date(year, 12, 25))]
+    # new year's day on a saturday is not moved to the last friday of the previous year
+    if date(year, 1, 1).weekday() != 5:
+        days.append(observed(date(year, 1, 1)))
+    if year >= 2022:
+        days.append(observed(date(year, 6, 19)))
+    return days
+
+def holidays(calendar, year):
+    if calendar == 'weekdays':
+        days = []
+    elif calendar == 'NBP':
+        days = polish_holidays(year)
+    elif calendar == 'NYSE':
+        days = nyse_holidays(year)
+    else:
+        raise Exception(f'Unknown business day calendar {calendar}')
+    return set([x for x in days + extra_holidays.get(calendar, []) if x.year == year])
+
+def get_table(calendar, year):
+    # (ordinal of january 1st, business day ordinals, number of business days up to each day of the year)
+    # the count is also the index of the first business day after that day
+    key = (calendar, year)
+    if key not in tables:
+        closed = holidays(calendar, year)
+        start = date(year, 1, 1).toordinal()
+        end = date(year + 1, 1, 1).toordinal()
+        business = []
+        after = []
+        for ordinal in range(start, end):
+            day = date.fromordinal(ordinal)
+            if day.weekday() not in weekend and day not in closed:
+                business.append(ordinal)
+            after.append(len(business))
+        tables[key] = (start, business, after)
+    return tables[key]
+
+def is_business_day(day, calendar='weekdays'):
+    start, business, after = get_table(calendar, day.year)
+    idx = after[day.toordinal() - start] - 1
+    return idx >= 0 and business[idx] == day.toordinal()
+
+def add_ordinal(ordinal, days, calendar):
+    # ordinal of the days-th business day after ordinal
+    year = date.fromordinal(ordinal).year
+    start, business, after = get_table(calendar, year)
+    idx = after[ordinal - start] + days - 1
+    while idx >= len(business):
+        idx -= len(business)
+        year += 1
+        start, business, after = get_table(calendar, year)
+    return business[idx]
+
+def add(day, days, calendar='weekdays'):
+    # day + days business days, works for dates and datetimes (the time is kept), days <= 0 returns day
+    if days <= 0:
+        return day
+    return day + timedelta(days=add_ordinal(day.toordinal(), days, calendar) - day.toordinal())
+
+def add_many(days_list, days, calendar='weekdays'):
+    resolved = {}
+    result = []
+    for day in days_list:
+        ordinal = day.toordinal()
+        if ordinal not in resolved:
+            resolved[ordinal] = ordinal if days <= 0 else add_ordinal(ordinal, days, calendar)
+        result.append(day + timedelta(days=resolved[ordinal] - ordinal))
+    return result
+
+def previous(day, calendar='weekdays'):
+    # last business day before day, as a date
+    year = day.year
+    start, business, after = get_table(calendar, year)
+    idx = after[day.toordinal() - start] - 1
+    if idx >= 0 and business[idx] == day.toordinal():
+        idx -= 1
+    while idx < 0:
+        year -= 1
+        start, business, after = get_table(calendar, year)
+        idx = len(business) - 1
+    return date.fromordinal(business[idx])
@@ -1,55 +1,53 @@
 import os, sys, re
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-from helpers import convert_rate, read_csv, warsaw_timezone, fiat_currencies
+from helpers import FxTotals, iter_csv, warsaw_timezone, fiat_currencies
+from profiling import count
 from decimal import Decimal
 from datetime import datetime
 
 operations_to_skip = ["Deposit", "Withdraw", "Savings purchase", "Savings Principal redemption", "transfer_out", "transfer_in", "Binance Card Spending", "Fiat Deposit", "Transfer Between Main and Funding Wallet", "Fiat Withdraw"]
 operations_to_process = ["Transaction Related", "Savings Interest", "Sell", "Distribution", "Transaction Sold", "Transaction Buy", "Transaction Fee", 'Transaction Revenue', 'Binance Convert']
+columns = ['User_ID', 'UTC_Time', 'Account', 'Operation', 'Coin', 'Change']
+# rows of other coins are skipped anyway, lines not mentioning a fiat currency are dropped before the csv parser
+prefilter = True
 
-def calculate_tax():
-    file_name = 'binance.csv'
-
+def calculate_tax(file_name = 'binance.csv'):
     if not os.path.exists(file_name):
         print(f'WARNING: Binance {file_name} doesnt exist. Skipping')
         return(None, None, None, None)
 
-    sheet = read_csv(file_name)
-
-    przychod_total = Decimal(0)
-    koszt_total = Decimal(0)
-    fiat_staking_total = Decimal(0)
+    fx = FxTotals()
 
-    for row in sheet:
-        if row["Account"] == "Card" or row["User_ID"] is None:
+    for user_id, utc_time, account, operation, coin, change in iter_csv(file_name, columns, [x.encode('utf-8') for x in fiat_currencies] if prefilter else None):
+        if account == "Card" or user_id is None:
+            count('rows_skipped')
             continue
-        coin = row["Coin"]
         if coin not in fiat_currencies:
+            count('rows_skipped')
             continue
 
-        if row["Account"].upper() not in ["SPOT", "SAVINGS", "CARD", "FUNDING"]:
-            raise Exception(f"Unknown account type for Binance: {row['Account']}")
+        if account.upper() not in ["SPOT", "SAVINGS", "CARD", "FUNDING"]:
+            raise Exception(f"Unknown account type for Binance: {account}")
 
-        operation = row["Operation"]
         if operation in operations_to_skip:
+            count('rows_skipped')
             continue
         if operation not in operations_to_process:
-            raise Exception(f'Unkown operation for Binance: {operation} for {row["Account"]} and {coin}')
+            raise Exception(f'Unkown operation for Binance: {operation} for {account} and {coin}')
 
-        asOfDate = row['UTC_Time'] if isinstance(row['UTC_Time'], datetime) else datetime.strptime(row['UTC_Time'], '%Y-%m-%d %H:%M:%S').astimezone(warsaw_timezone)
-        change = Decimal(str(row["Change"]))
-        pln = round(convert_rate(asOfDate, change, currency=coin), 2)
+        asOfDate = utc_time if isinstance(utc_time, datetime) else datetime.strptime(utc_time, '%Y-%m-%d %H:%M:%S').astimezone(warsaw_timezone)
+        change = Decimal(str(change))
 
         if operation in ["Distribution", "Savings Interest"]:
-            fiat_staking_total += pln
+            fx.add('fiat_staking', asOfDate, change, coin)
         elif operation == "Transaction Fee":
             if change >= 0:
                 raise Exception(f"Found positive fee {change}")
-            koszt_total -= pln
+            fx.add('koszt', asOfDate, change, coin, -1)
         elif change < 0:
-            koszt_total -= pln
+            fx.add('koszt', asOfDate, change, coin, -1)
         else:
-            przychod_total += pln
+            fx.add('przychod', asOfDate, change, coin)
 
-    return ("Binance", przychod_total, koszt_total, fiat_staking_total)
\ No newline at end of file
+    return ("Binance", fx.get('przychod'), fx.get('koszt'), fx.get('fiat_staking'))
\ No newline at end of file
@@ -3,57 +3,70 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 from openpyxl import load_workbook
 import datetime
-from helpers import convert_rate, convert_sheet, warsaw_timezone, fiat_currencies
+from helpers import convert_rate, iter_sheet, warsaw_timezone, fiat_currencies
+from profiling import count
 from decimal import Decimal
 
 operations_to_skip = []
 operations_to_process = ["MARKET_SELL", "LIMIT_SELL", "CEILING_MARKET_BUY", "LIMIT_BUY"]
 excel_date_format = '%m/%d/%Y %I:%M:%S %p'
+columns = ['Uuid', 'Exchange', 'OrderType', 'Closed', 'Price', 'Commission']
 
-def calculate_tax():
-    file_name = 'bittrex.xlsx'
+def is_relevant(row):
+    # only EUR markets count, unknown types and invalid tickers still reach the loop to raise
+    if row['OrderType'] not in operations_to_skip + operations_to_process or not isinstance(row['Exchange'], str):
+        return True
+    ticker = row['Exchange'].split('-')
+    return len(ticker) != 2 or 'EUR' in ticker
 
+def calculate_tax(file_name = 'bittrex.xlsx'):
     if not os.path.exists(file_name):
         print(f'WARNING: Bittrex {file_name} doesnt exist. Skipping')
         return(None, None, None, None)
 
-    workbook = load_workbook(filename=file_name)
-    transactions = convert_sheet(workbook[workbook.sheetnames[0]])
+    workbook = load_workbook(filename=file_name, read_only=True)
+    transactions = iter_sheet(workbook[workbook.sheetnames[0]], columns, is_relevant)
 
     przychod_total = Decimal(0)
     koszt_total = Decimal(0)
     fiat_staking_total = Decimal(0)
 
-    for row in transactions:
-        if row['Uuid'] is None:
-            continue
-
-        type = row['OrderType']
-        if type in operations_to_skip:
-            continue
-        if type not in operations_to_process:
-            raise Exception(f'Bittrex. Unknown transaction type {type}')
-
-        asOfDate = datetime.datetime.strptime(row['Closed'], excel_date_format)
-        trade_id = row["Uuid"]
-        price = Decimal(str(row["Price"]))
-        fee = Decimal(str(row["Commission"]))
-        ticker = row["Exchange"].split('-')
-        if len(ticker) != 2:
-            raise Exception(f'Bittrex invalid ticker for {trade_id}')
-
-        pln = convert_rate(asOfDate, price, currency='EUR')
-        if ticker[0] == 'EUR':
-            koszt_total += convert_rate(asOfDate, fee, currency='EUR')
-            if 'SELL' in type:
-                przychod_total += pln
-            else:
-                koszt_total += pln
-        elif ticker[1] == 'EUR':
-            raise Exception('Bittrex: Untested')
-            # if 'SELL' in type:
-            #     koszt_total += pln
-            # else:
-            #     przychod_total += pln
+    try:
+        for row in transactions:
+            if row['Uuid'] is None:
+                count('rows_skipped')
+                continue
 
+            type = row['OrderType']
+            if type in operations_to_skip:
+                count('rows_skipped')
+                continue
+            if type not in operations_to_process:
+                raise Exception(f'Bittrex. Unknown transaction type {type}')
+
+            asOfDate = datetime.datetime.strptime(row['Closed'], excel_date_format)
+            trade_id = row["Uuid"]
+            price = Decimal(str(row["Price"]))
+            fee = Decimal(str(row["Commission"]))
+            ticker = row["Exchange"].split('-')
+            if len(ticker) != 2:
+                raise Exception(f'Bittrex invalid ticker for {trade_id}')
+
+            pln = convert_rate(asOfDate, price, currency='EUR')
+            if ticker[0] == 'EUR':
+                koszt_total += convert_rate(asOfDate, fee, currency='EUR')
+                if 'SELL' in type:
+                    przychod_total += pln
+                else:
+                    koszt_total += pln
+            elif ticker[1] == 'EUR':
+                raise Exception('Bittrex: Untested')
+                # if 'SELL' in type:
+                #     koszt_total += pln
+                # else:
+                #     przychod_total += pln
+    finally:
+        # a half read sheet keeps the file open even after the workbook is closed
+        transactions.close()
+        workbook.close()
     return ("Bittrex", round(przychod_total, 2), round(koszt_total, 2), round(fiat_staking_total, 2))
\ No newline at end of file
@@ -1,29 +1,88 @@
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from profiling import stage, run_staged, merge
+import helpers, result_cache
 import binance, coinbase, kraken, bittrex, nexo
 
-exchanges = [binance.calculate_tax, coinbase.calculate_tax, kraken.calculate_tax, bittrex.calculate_tax, nexo.calculate_tax]
+exchanges = [(binance.calculate_tax, 'binance.csv'), (coinbase.calculate_tax, 'coinbase.csv'), (kraken.calculate_tax, 'kraken.xlsx'), (bittrex.calculate_tax, 'bittrex.xlsx'), (nexo.calculate_tax, 'nexo.csv')]
+workers = min(len(exchanges), os.cpu_count() or 1) # 1 runs the exchanges one after another
+# openpyxl parsing holds the GIL, these exchanges go to worker processes, the csv ones run in threads
+process_exchanges = ['kraken', 'bittrex']
+
+def run_exchange(exchange, path):
+    with stage(f'exchange_{exchange.__module__}'):
+        return exchange(path)
+
+def run_exchanges(folder):
+    # results come back in the order of exchanges whatever finishes first
+    jobs = [(exchange, os.path.join(folder, file_name)) for exchange, file_name in exchanges]
+    if workers <= 1:
+        return [run_exchange(exchange, path) for exchange, path in jobs]
 
-przychod_total = Decimal(0)
-koszt_total = Decimal(0)
-dochod_total = Decimal(0)
-fiat_staking_total = Decimal(0)
+    # missing files only print a warning, keep them in the main thread so the output order is stable
+    results = dict([(idx, run_exchange(exchange, path)) for idx, (exchange, path) in enumerate(jobs) if not os.path.exists(path)])
+    pending = [(idx, exchange, path) for idx, (exchange, path) in enumerate(jobs) if idx not in results]
+    process_jobs = [(idx, exchange, path) for idx, exchange, path in pending if exchange.__module__ in process_exchanges]
+    if len(process_jobs) == 0:
+        run_threads(pending, results)
+        return [results[idx] for idx in range(len(jobs))]
 
-for exchange in exchanges:
-    exchange_name, przychod, koszt, fiat_staking = exchange()
-    if exchange_name is None:
-        continue
+    # the workers get the tables already in memory and fetch the rest themselves like a sequential run.
+    # with fork every worker process starts on the first submit, before any thread could hold rates_lock
+    with ProcessPoolExecutor(max_workers=min(workers, len(process_jobs)), initializer=helpers.use_rates_snapshot, initargs=(helpers.rates_cache,)) as processes:
+        # the exchange function pickles by its module name, the worker returns the stages and counters it recorded
+        processed = dict([(idx, processes.submit(run_staged, f'exchange_{exchange.__module__}', exchange, path)) for idx, exchange, path in process_jobs])
+        run_threads([x for x in pending if x[0] not in processed], results)
+        for idx, future in processed.items():
+            results[idx], worker_stages, worker_counters = future.result()
+            merge(worker_stages, worker_counters)
+    return [results[idx] for idx in range(len(jobs))]
 
-    dochod = (przychod - koszt) if przychod > koszt else Decimal(0)
-    print(f"Giełda: {exchange_name}\nPrzychód: {przychod}zł Koszt: {koszt}zł Dochód: {dochod}zł Fiat staking: {fiat_staking}zł")
-    przychod_total += przychod
-    koszt_total += koszt
-    fiat_staking_total += fiat_staking
+def run_threads(pending, results):
+    with ThreadPoolExecutor(max_workers=workers) as threads:
+        futures = [(idx, threads.submit(run_exchange, exchange, path)) for idx, exchange, path in pending]
+        for idx, future in futures:
+            results[idx] = future.result()
 
-dochod_total = przychod_total - koszt_total
-if dochod_total < 0:
+def calculate(folder = ''):
+    paths = [os.path.join(folder, file_name) for _, file_name in exchanges]
+    settings = {'exchanges': [exchange.__module__ for exchange, _ in exchanges], 'nexo_tax_rate': str(nexo.tax_rate), 'fx_aggregation': helpers.fx_aggregation}
+    return result_cache.cached('crypto', paths, settings, lambda: calculate_exchanges(folder))
+
+def calculate_exchanges(folder):
+    results = []
+    przychod_total = Decimal(0)
+    koszt_total = Decimal(0)
     dochod_total = Decimal(0)
-rollover_koszt = Decimal(0) if przychod_total > koszt_total else -(przychod_total - koszt_total)
-print()
-print("Łącznie")
-print(f"Przychód: {przychod_total}zł Koszt: {koszt_total}zł Dochód: {dochod_total}zł Rollover koszt: {rollover_koszt} (dodać poprzedni rok!)")
-print(f"Fiat staking: {fiat_staking_total}zł")
\ No newline at end of file
+    fiat_staking_total = Decimal(0)
+
+    for exchange_name, przychod, koszt, fiat_staking in run_exchanges(folder):
+        if exchange_name is None:
+            continue
+
+        dochod = (przychod - koszt) if przychod > koszt else Decimal(0)
+        results.append({'exchange': exchange_name, 'przychod': przychod, 'koszt': koszt, 'dochod': dochod, 'fiat_staking': fiat_staking})
+        przychod_total += przychod
+        koszt_total += koszt
+        fiat_staking_total += fiat_staking
+
+    dochod_total = przychod_total - koszt_total
+    if dochod_total < 0:
+        dochod_total = Decimal(0)
+    rollover_koszt = Decimal(0) if przychod_total > koszt_total else -(przychod_total - koszt_total)
+    return {'exchanges': results, 'przychod': przychod_total, 'koszt': koszt_total, 'dochod': dochod_total, 'rollover_koszt': rollover_koszt, 'fiat_staking': fiat_staking_total}
+
+def main():
+    r = calculate()
+    for x in r['exchanges']:
+        print(f"Giełda: {x['exchange']}\nPrzychód: {x['przychod']}zł Koszt: {x['koszt']}zł Dochód: {x['dochod']}zł Fiat staking: {x['fiat_staking']}zł")
+    print()
+    print("Łącznie")
+    print(f"Przychód: {r['przychod']}zł Koszt: {r['koszt']}zł Dochód: {r['dochod']}zł Rollover koszt: {r['rollover_koszt']} (dodać poprzedni rok!)")
+    print(f"Fiat staking: {r['fiat_staking']}zł")
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -1,42 +1,41 @@
 import os, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-from helpers import read_csv, fiat_currencies, warsaw_timezone, convert_rate
+from helpers import iter_csv, fiat_currencies, warsaw_timezone, convert_rate
+from profiling import count
 from decimal import Decimal
 from datetime import datetime
 
 operations_to_skip = ["deposit", "withdrawal", "send", "receive", "reward income"]
 operations_to_process = ["advanced trade buy", "advanced trade sell",]
+columns = ['Timestamp', 'Transaction Type', 'Asset', 'Price Currency', 'Total (inclusive of fees and/or spread)', 'Notes']
 
-def calculate_tax():
-    file_name = 'coinbase.csv'
-
+def calculate_tax(file_name = 'coinbase.csv'):
     if not os.path.exists(file_name):
         print(f'WARNING: Coinbase {file_name} doesnt exist. Skipping')
         return (None, None, None, None)
 
-    transactions = read_csv(file_name)
     przychod_total = Decimal(0)
     koszt_total = Decimal(0)
     fiat_staking_total = Decimal(0)
 
-    for row in transactions:
-        if row.get('Transaction Type') is None:
+    for timestamp, transaction_type, asset, price_currency, total, notes in iter_csv(file_name, columns):
+        if transaction_type is None:
             raise Exception("Coinbase. Missing 'Transaction Type' column")
 
-        type = row['Transaction Type'].lower()
+        type = transaction_type.lower()
         if type in operations_to_skip:
+            count('rows_skipped')
             continue
-        if type == 'convert' and 'USDT' in row['Notes'] and 'USDC' in row['Notes']:
+        if type == 'convert' and 'USDT' in notes and 'USDC' in notes:
+            count('rows_skipped')
             continue
         if type not in operations_to_process:
             raise Exception(f'Coinbase. Unknown transaction type {type}')
 
-        raw_time = row["Timestamp"].replace('UTC', '').strip() 
-        asset = row["Asset"]
-        price_currency = row["Price Currency"]
+        raw_time = timestamp.replace('UTC', '').strip() 
         asOfDate = datetime.strptime(raw_time, '%Y-%m-%d %H:%M:%S').astimezone(warsaw_timezone)
-        total = Decimal(str(row["Total (inclusive of fees and/or spread)"].replace('€', '')))
+        total = Decimal(str(total.replace('€', '')))
         total_pln = round(convert_rate(asOfDate, total, currency=price_currency), 2)
         if price_currency not in fiat_currencies:
             raise Exception(f"Coinbase. Unknown price currency {price_currency}")
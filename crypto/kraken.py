@@ -2,70 +2,76 @@ import os, sys, re
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 from openpyxl import load_workbook
-from helpers import convert_rate, convert_sheet, warsaw_timezone
+from helpers import FxTotals, iter_sheet, warsaw_timezone
+from profiling import count
 from decimal import Decimal
 from datetime import datetime
 
 operations_to_skip = ["deposit", "withdrawal", "transfer"]
 operations_to_process = ["staking", "trade", "spend", "receive"]
+eur_assets = ['ZEUR', 'EUR.M']
+columns = ['txid', 'time', 'type', 'asset', 'amount', 'fee']
 
-def calculate_tax():
-    file_name = 'kraken.xlsx'
+def is_relevant(row):
+    # other assets are skipped anyway, rows of unknown types still reach the loop to raise
+    return row['asset'] in eur_assets or row['type'] not in operations_to_skip + operations_to_process
 
+def calculate_tax(file_name = 'kraken.xlsx'):
     if not os.path.exists(file_name):
         print(f'WARNING: Kraken {file_name} doesnt exist. Skipping')
         return(None, None, None, None)
 
-    workbook = load_workbook(filename=file_name)
-    transactions = convert_sheet(workbook[workbook.sheetnames[0]])
+    workbook = load_workbook(filename=file_name, read_only=True)
+    transactions = iter_sheet(workbook[workbook.sheetnames[0]], columns, is_relevant)
 
-    przychod_total = Decimal(0)
-    koszt_total = Decimal(0)
-    fiat_staking_total = Decimal(0)
+    fx = FxTotals()
 
-    for row in transactions:
-        if row['time'] is None:
-            continue
+    try:
+        for row in transactions:
+            if row['time'] is None:
+                count('rows_skipped')
+                continue
 
-        type = row["type"]
-        if type in operations_to_skip:
-            continue
-        if type not in operations_to_process:
-            raise Exception(f'Unkown operation for Kraken: {type}')
+            type = row["type"]
+            if type in operations_to_skip:
+                count('rows_skipped')
+                continue
+            if type not in operations_to_process:
+                raise Exception(f'Unkown operation for Kraken: {type}')
 
-        txid = row["txid"]
-        amount = Decimal(str(row['amount']))
-        fee = Decimal(str(row['fee']))
-        asOfDate = row["time"] if isinstance(row["time"], datetime) else datetime.strptime(row["time"], '%Y-%m-%d %H:%M:%S').astimezone(warsaw_timezone)
-        if row['asset'] not in ['ZEUR', 'EUR.M']:
-            continue
+            txid = row["txid"]
+            amount = Decimal(str(row['amount']))
+            fee = Decimal(str(row['fee']))
+            asOfDate = row["time"] if isinstance(row["time"], datetime) else datetime.strptime(row["time"], '%Y-%m-%d %H:%M:%S').astimezone(warsaw_timezone)
+            if row['asset'] not in eur_assets:
+                count('rows_skipped')
+                continue
 
-        pln_amount = convert_rate(asOfDate, amount, currency='EUR')
-        fee_pln = convert_rate(asOfDate, fee, currency='EUR')
+            # the checks use the converted amount of the row when it is known, like the per row conversion always did
+            if type == 'staking':
+                fx.add('fiat_staking', asOfDate, amount, 'EUR')
+            elif type == 'spend':
+                pln_amount = fx.add('koszt', asOfDate, amount, 'EUR', -1)
+                if (amount if pln_amount is None else pln_amount) >= 0:
+                    raise Exception(f"Kraken: positive spend transaction for txin: {txid}")
+                if not fee.is_zero():
+                    raise Exception(f"Kraken: positive fee for spend transaction for txin: {txid}")
+            elif type == "receive":
+                pln_amount = fx.add('przychod', asOfDate, amount, 'EUR')
+                if (amount if pln_amount is None else pln_amount) <= 0:
+                    raise Exception(f"Kraken: negative receive transaction for txin: {txid}")
+                if not fee.is_zero():
+                    raise Exception(f"Kraken: positive fee for receive transaction for txin: {txid}")
 
-        if type == 'staking':
-            fiat_staking_total += pln_amount
-        elif type == 'spend':
-            if pln_amount >= 0:
-                raise Exception(f"Kraken: positive spend transaction for txin: {txid}")
-            if not fee.is_zero():
-                raise Exception(f"Kraken: positive fee for spend transaction for txin: {txid}")
-            koszt_total -= pln_amount
-        elif type == "receive":
-            if pln_amount <= 0:
-                raise Exception(f"Kraken: negative receive transaction for txin: {txid}")
-            if not fee.is_zero():
-                raise Exception(f"Kraken: positive fee for receive transaction for txin: {txid}")
-
-            przychod_total += pln_amount
-
-        elif type == "trade":
-            if not fee.is_zero():
-                koszt_total += fee_pln
-            if pln_amount > 0:
-                przychod_total += pln_amount
-            else:
-                koszt_total -= pln_amount
-
-
-    return ("Kraken", round(przychod_total, 2), round(koszt_total, 2), round(fiat_staking_total, 2))
\ No newline at end of file
+            elif type == "trade":
+                if not fee.is_zero():
+                    fx.add('koszt', asOfDate, fee, 'EUR')
+                if amount > 0:
+                    fx.add('przychod', asOfDate, amount, 'EUR')
+                else:
+                    fx.add('koszt', asOfDate, amount, 'EUR', -1)
+    finally:
+        # a half read sheet keeps the file open even after the workbook is closed
+        transactions.close()
+        workbook.close()
+    return ("Kraken", round(fx.get('przychod'), 2), round(fx.get('koszt'), 2), round(fx.get('fiat_staking'), 2))
\ No newline at end of file
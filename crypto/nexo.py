@@ -3,34 +3,33 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 from datetime import datetime
 from decimal import Decimal
-from helpers import convert_rate, read_csv, warsaw_timezone
+from helpers import convert_rate, iter_csv, warsaw_timezone
+from profiling import count
 
 tax_rate = Decimal("0.19")
 income_types = []
 cost_types = []
 
 trans_types_to_ignore = ['Interest','Fixed Term Interest', 'Unlocking Term Deposit']
+columns = ['Date / Time (UTC)', 'Type', 'Input Currency', 'Output Currency', 'Input Amount']
 
-def calculate_tax():
+def calculate_tax(file_name = 'nexo.csv'):
     income = Decimal("0")
     cost = Decimal("0")
-    file_name = 'nexo.csv'
     if not os.path.exists(file_name):
         print(f'WARNING: Kraken {file_name} doesnt exist. Skipping')
         return(None, None, None, None)
 
-    sheet = read_csv(file_name)
-    for row in sheet:
-        if row['Date / Time (UTC)'] is None:
+    for date_time, trans_type, input_currency, output_currency, amount in iter_csv(file_name, columns):
+        if date_time is None:
+            count('rows_skipped')
             continue
-        trans_type = row['Type']
         if trans_type in trans_types_to_ignore:
+            count('rows_skipped')
             continue
 
-        input_currency = row['Input Currency']
-        output_currency = row['Output Currency']
-        amount = Decimal(str(row["Input Amount"]))
-        date = row['Date / Time (UTC)'] if isinstance(row['Date / Time (UTC)'], datetime) else datetime.strptime(row['Date / Time (UTC)'], '%Y-%m-%d %H:%M:%S').astimezone(warsaw_timezone)
+        amount = Decimal(str(amount))
+        date = date_time if isinstance(date_time, datetime) else datetime.strptime(date_time, '%Y-%m-%d %H:%M:%S').astimezone(warsaw_timezone)
 
         if trans_type == 'Exchange To Withdraw':
             if output_currency == 'EUR' or 'USD':
@@ -1,11 +1,15 @@
-import os, sys
+import os, sys, json, hashlib
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 from openpyxl import load_workbook
 from datetime import datetime, timedelta
+import business_days
 from decimal import Decimal
-from mapping import get_country_code, CryptoCountry, CfdCountry
-from helpers import sum_dict, convert_rate, convert_sheet
+from mapping import get_country_code, prefetch_country_codes, CryptoCountry, CfdCountry
+from helpers import sum_dict, convert_rate, iter_sheet, prefetch_rates, rate_tables_needed
+from money import SubCentAmount, parse_cents, to_decimal, convert_cents, mul_round, round_units
+from profiling import stage, count
+import result_cache
 
 # pos_types: crypto, stock, dividend, fee
 CryptoType = 'crypto'
@@ -19,7 +23,14 @@ RefundType = 'refund'
 
 tax_rate = Decimal("0.19")
 use_t_plus_2 = False
+t2_calendar = 'weekdays' # 'NYSE' also skips the US exchange holidays, see business_days.py
+use_fixed_point = False # keep USD/PLN amounts as int cents/grosze in the hot loops
+engine = 'rows' # 'numpy' converts and sums the PLN amounts with numpy arrays (needs numpy installed), results are the same
 year = 2024
+checkpoint_path = None # e.g. 'checkpoint_2024.json', positions with unchanged rows are taken from the previous run
+checkpoint_version = 1
+streaming = False # stream Account Activity row by row, memory grows with the number of positions instead of rows
+stream_flush_rows = 10000 # pending PLN conversions are flushed every that many rows while streaming
 ignored_transactions = ['Deposit',
                         'Start Copy',
                         'Account balance to mirror',
@@ -31,17 +42,61 @@ ignored_transactions = ['Deposit',
                         'AirDrop',
                         'Staking']
 excel_date_format = '%d/%m/%Y %H:%M:%S'
+# raw rows keep only the columns the calculator reads
+activity_columns = ['Position ID', 'Date', 'Amount', 'Type', 'Details', 'Asset type', 'Realized Equity Change']
+closed_position_columns = ['Position ID', 'Open Date', 'Close Date', 'Type', 'Action', 'Amount']
+
+class Entry:
+    __slots__ = ('id', 'type', 'date', 'amount', 'is_cfd', 'equity_change', 'open_amount', 'close_amount', 'open_date', 'close_date')
+
+    def __init__(self, id, type, date=None, amount=None, is_cfd=False, equity_change=None, open_amount=None, close_amount=None, open_date=None, close_date=None):
+        self.id = id
+        self.type = type
+        self.date = date
+        self.amount = amount
+        self.is_cfd = is_cfd
+        self.equity_change = equity_change
+        self.open_amount = open_amount
+        self.close_amount = close_amount
+        self.open_date = open_date
+        self.close_date = close_date
+
+class Statement:
+    def __init__(self, path):
+        self.path = path
+        with stage('workbook_load'):
+            self.workbook = load_workbook(filename=path, read_only=True)
+        self.sheets = {}
+        self.streams = []
+
+    def sheet(self, name, columns=None):
+        if name not in self.sheets:
+            with stage('sheet_conversion'):
+                self.sheets[name] = list(iter_sheet(self.workbook[name], columns))
+        return self.sheets[name]
+
+    def stream(self, name, columns=None):
+        # rows read one by one, a stream left half read keeps the file open until it is closed
+        rows = iter_sheet(self.workbook[name], columns)
+        self.streams.append(rows)
+        return rows
+
+    def close(self):
+        for rows in self.streams:
+            rows.close()
+        self.workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 def t2_date(date: datetime):
     if not use_t_plus_2:
         return date
 
-    num_days = 2
-    while num_days > 0:
-        date += timedelta(days=1)
-        if date.weekday() < 5: # Monday to Friday are considered weekdays
-            num_days -= 1
-
+    date = business_days.add(date, 2, t2_calendar)
     if date.day == 1 and date.month == 1:
         date += timedelta(days=1)
     return date
@@ -56,18 +111,33 @@ def group_by_pos_id(transactions):
 
     return res
 
-def get_ticker_country(position, transactions, closed_positions, dividends):
-    pos_id = position['id']
+def get_ticker_country(position, transactions, closed_positions, dividends, countries):
+    pos_id = position.id
     if pos_id not in transactions:
         raise Exception(f'Logic error. Unable to find position {pos_id} in transactions sheet')
 
-    if position['type'] == CryptoType:
+    country = get_direct_country(position)
+    if country is not None:
+        return country
+    if pos_id in countries:
+        return countries[pos_id]
+
+    stock_name, stock_symbol = get_ticker_names(pos_id, transactions, closed_positions, dividends)
+    with stage('country_mapping'):
+        countries[pos_id] = get_country_code(stock_name, stock_symbol)
+    return countries[pos_id]
+
+def get_direct_country(position):
+    # None for stocks, their country comes from the instruments
+    if position.type == CryptoType:
         return CryptoCountry
-    elif position['is_cfd']:
+    elif position.is_cfd:
         return CfdCountry
-    elif position['type'] not in [StockType, FeeType]:
-        raise Exception(f'Unexpected position type {position["type"]} for {pos_id}')
+    elif position.type not in [StockType, FeeType]:
+        raise Exception(f'Unexpected position type {position.type} for {position.id}')
+    return None
 
+def get_ticker_names(pos_id, transactions, closed_positions, dividends):
     first_transaction = next((t for t in transactions[pos_id] if t['Type'] in ['Position closed', 'Open Position', 'Dividend']))
     closed_position = closed_positions[pos_id][0] if pos_id in closed_positions else None
     stock_name = None if closed_position is None else closed_position["Action"]
@@ -76,11 +146,40 @@ def get_ticker_country(position, transactions, closed_positions, dividends):
     if closed_position is None:
         dividend = dividends[pos_id][0] if pos_id in dividends else None
         stock_name = None if dividend is None else dividend["Instrument Name"]
-
-    return get_country_code(stock_name, stock_symbol)
+    return (stock_name, stock_symbol)
+
+def prefetch_ticker_countries(positions, transactions, closed_positions, dividends):
+    # stocks the instruments list can't resolve are looked up on etoro in batches before the positions are processed
+    pos_ids = set([x.id for x in positions if x.type in [StockType, FeeType] and not x.is_cfd and x.id in transactions])
+    stocks = []
+    for pos_id in pos_ids:
+        try:
+            stocks.append(get_ticker_names(pos_id, transactions, closed_positions, dividends))
+        except StopIteration:
+            continue
+    with stage('country_mapping'):
+        prefetch_country_codes(stocks)
 
 def parse_decimal(r):
     return Decimal(str(r))
+
+def parse_amount(r):
+    return parse_cents(r) if use_fixed_point else parse_decimal(r)
+
+def zero_amount():
+    return 0 if use_fixed_point else Decimal('0')
+
+def to_pln(date, amount):
+    return convert_cents(date, amount, 'USD') if use_fixed_point else convert_rate(date, amount, currency='USD', dec_places=2)
+
+def apply_rate(rate, amount):
+    return mul_round(amount, rate) if use_fixed_point else round(rate * amount, 2)
+
+def round_total(amount):
+    return round_units(amount) if use_fixed_point else round(amount)
+
+def output_amount(amount):
+    return to_decimal(amount) if use_fixed_point else amount
     
 def parse_date(r):
     return datetime.strptime(r, excel_date_format)
@@ -92,24 +191,22 @@ def is_asset_cfd(r):
 
 def process_interest_payment(transaction):
     pos_id = transaction["Position ID"]
-    amount = parse_decimal(transaction["Amount"])
+    amount = parse_amount(transaction["Amount"])
     date = parse_date(transaction['Date'])
-    trans = {'id': pos_id, 'date': date, 'amount': amount, "type": InterestType, 'equity_change': amount, "is_cfd": True}
-    return trans
+    return Entry(pos_id, InterestType, date=date, amount=amount, equity_change=amount, is_cfd=True)
 
 def process_adjustment(transaction):
     pos_id = transaction["Position ID"]
-    amount = parse_decimal(transaction["Amount"])
+    amount = parse_amount(transaction["Amount"])
     date = parse_date(transaction['Date'])
     if transaction['Type'] == 'Index price adjustment':
         type = IndexAdjustmentType
     else:
         type = AdjustmentType
-    trans = {'id': pos_id, 'date': date, 'amount': amount, "type": type, 'equity_change': amount, "is_cfd": True}
-    return trans
+    return Entry(pos_id, type, date=date, amount=amount, equity_change=amount, is_cfd=True)
 
 def process_rollover_fee(transaction):
-    amount = parse_decimal(transaction["Amount"])
+    amount = parse_amount(transaction["Amount"])
     pos_id = transaction["Position ID"]
     date = parse_date(transaction['Date'])
 
@@ -126,11 +223,10 @@ def process_rollover_fee(transaction):
     else:
         raise Exception(f"Unkown fee {transaction_details} for position {transaction['Position ID']}")
 
-    return {'id': pos_id, 'date': date, 'amount': amount, "type": pos_type, "is_cfd": is_asset_cfd(transaction)}
+    return Entry(pos_id, pos_type, date=date, amount=amount, is_cfd=is_asset_cfd(transaction))
 
-def read_dividend_taxes(path):
-    workbook = load_workbook(filename=path)
-    sheet = convert_sheet(workbook['Dividends'])
+def read_dividend_taxes(statement):
+    sheet = statement.sheet('Dividends')
     dividend_taxes = {}
     for x in sheet:
         pos_id = str(x["Position ID"])
@@ -140,8 +236,8 @@ def read_dividend_taxes(path):
             dividend_taxes[pos_id] = []
 
         x["Withholding Tax Rate (%)"] = parse_decimal(x["Withholding Tax Rate (%)"].replace('%', '')) / Decimal("100")
-        x["Net Dividend Received (USD)"] = parse_decimal(x["Net Dividend Received (USD)"])
-        x["Withholding Tax Amount (USD)"] = parse_decimal(x["Withholding Tax Amount (USD)"])
+        x["Net Dividend Received (USD)"] = parse_amount(x["Net Dividend Received (USD)"])
+        x["Withholding Tax Amount (USD)"] = parse_amount(x["Withholding Tax Amount (USD)"])
         x["Date of Payment"] = datetime.strptime(str(x["Date of Payment"]), '%d/%m/%Y')
 
         if x["Date of Payment"].year != year:
@@ -159,14 +255,17 @@ def get_asset_type(asset):
     else:
         raise Exception(f'Failed to parse {asset}')
 
-def read(path):
-    workbook = load_workbook(filename=path)
-    transactions = convert_sheet(workbook['Account Activity'])
+def read(statement):
+    transactions = statement.sheet('Account Activity', activity_columns)
     grouped_transactions = group_by_pos_id(transactions)
-    closed_positions = convert_sheet(workbook['Closed Positions'])
+    closed_positions = statement.sheet('Closed Positions', closed_position_columns)
     grouped_closed_positions = group_by_pos_id(closed_positions)
-    entries = []
 
+    check_closed_positions(closed_positions, lambda pos_id: next((x for x in grouped_transactions[pos_id] if x['Type'] == 'Position closed'), None) is not None)
+    entries = list(parse_activity(transactions, grouped_closed_positions))
+    return (entries, grouped_transactions, grouped_closed_positions)
+
+def check_closed_positions(closed_positions, has_closed_activity):
     # sanity checks... because etoro does more bugs than I
     has_fatal_errors = False
     for row  in closed_positions:
@@ -182,51 +281,46 @@ def read(path):
         if is_sell and not is_cfd:
             raise Exception(f"Not CFD that is sell? Pos id {pos_id}")
 
-        if open_date.year == close_date.year:
-            open_activity = next((x for x in grouped_transactions[pos_id] if x['Type'] == 'Position closed'), None)
-            if open_activity is None:
-                print(f'FATAL ERROR: Missing closed position, report to ETORO! Position id: {pos_id}')
-                has_fatal_errors = True
+        if open_date.year == close_date.year and not has_closed_activity(pos_id):
+            print(f'FATAL ERROR: Missing closed position, report to ETORO! Position id: {pos_id}')
+            has_fatal_errors = True
 
     if has_fatal_errors:
         raise Exception('Aborting due to fatal errors')
 
+def parse_activity(transactions, grouped_closed_positions):
     for row in transactions:
         pos_id = row['Position ID']
         if pos_id is None:
+            count('rows_skipped')
             continue
 
         date = parse_date(row['Date'])
-        amount = parse_decimal(row["Amount"])
+        amount = parse_amount(row["Amount"])
         trans_type = row['Type']
         asset_type = row['Asset type']
-        trans = { 'id': pos_id }
         if date.year != year:
             raise Exception('Invalid year found in excel')
 
         if trans_type in ['Overnight fee', 'Overnight refund', 'Weekend refund', 'Dividend', 'SDRT']:
-            entries.append(process_rollover_fee(row))
+            yield process_rollover_fee(row)
         elif trans_type == 'Interest Payment':
-            entries.append(process_interest_payment(row))
+            yield process_interest_payment(row)
         elif trans_type in ['Adjustment', 'Index price adjustment']:
-            entries.append(process_adjustment(row))
+            yield process_adjustment(row)
         elif trans_type in ['Withdraw Fee', 'Withdrawal Conversion Fee', 'Deposit Conversion Fee']:
             if amount != 0:
                 raise Exception(f'Unsupported withdraw fee/withdrawal conversion fee/depsit conversion fee {amount}')
         elif trans_type == "Open Position":
             # skip as it's taxable only for crypto
             if get_asset_type(row) != CryptoType:
+                count('rows_skipped')
                 continue
             if amount <= 0:
                 raise Exception(f'Negative crypto buy? {amount}')
-            trans['amount'] = -amount
-            trans['date'] = date
-            trans['type'] = CryptoType
-            trans['is_cfd'] = False
-            trans['equity_change'] = profit = parse_decimal(row['Realized Equity Change'])
-            entries.append(trans)
+            yield Entry(pos_id, CryptoType, date=date, amount=-amount, is_cfd=False, equity_change=parse_amount(row['Realized Equity Change']))
         elif trans_type == "Position closed":
-            profit = parse_decimal(row['Realized Equity Change'])
+            profit = parse_amount(row['Realized Equity Change'])
             parsed_asset_type = get_asset_type(row)
             closed_position = grouped_closed_positions[pos_id][0]
             is_cfd = asset_type == 'CFD'
@@ -237,10 +331,7 @@ def read(path):
             else:
                 open_date = t2_date(parse_date(closed_position['Open Date']))
                 close_date = t2_date(parse_date(closed_position['Close Date']))
-            open_amount = parse_decimal(closed_position['Amount'])
-
-            trans['type'] = parsed_asset_type
-            trans['equity_change'] = profit
+            open_amount = parse_amount(closed_position['Amount'])
 
             if len(grouped_closed_positions[pos_id]) > 1:
                 raise Exception(f'More than one closed position for {pos_id}')
@@ -250,28 +341,21 @@ def read(path):
                 raise Exception(f'Negative amount for position id {pos_id}')
 
             if parsed_asset_type == CryptoType:
-                trans['date'] = close_date
-                trans['amount'] = amount
-                trans['is_cfd'] = False
+                trans = Entry(pos_id, parsed_asset_type, date=close_date, amount=amount, is_cfd=False, equity_change=profit)
             elif parsed_asset_type == StockType:
-                trans['is_cfd'] = is_cfd
-                trans['open_amount'] = open_amount
-                trans['close_amount'] = amount
-                trans['open_date'] = open_date
-                trans['close_date'] = close_date
+                trans = Entry(pos_id, parsed_asset_type, is_cfd=is_cfd, equity_change=profit, open_amount=open_amount, close_amount=amount, open_date=open_date, close_date=close_date)
             else:
                 raise Exception(r"Unexpected asset type '{parsed_asset_type}' for {pos_id}")
 
-            entries.append(trans)
+            yield trans
 
         elif trans_type not in ignored_transactions:
             raise Exception(f'Unknown transaction type "{trans_type}" for position {pos_id}')
+        else:
+            count('rows_skipped')
 
-    return (entries, grouped_transactions, grouped_closed_positions)
-
-def read_summary(path):
-    workbook = load_workbook(filename=path)
-    summary = convert_sheet(workbook['Financial Summary'])
+def read_summary(statement):
+    summary = statement.sheet('Financial Summary')
     stock_sum = Decimal('0')
     crypto_sum = Decimal('0')
     dividends_sum = Decimal('0')
@@ -307,162 +391,500 @@ def read_summary(path):
 
     return (stock_sum, crypto_sum, dividends_sum, fees_sum, interest_sum, refunds_sum, index_adjustments_sum)
 
-def process_positions(input_positions, typ, unmatched_dividend_position_ids, transactions, closed_positions, dividends):
-    positions = list([x for x in input_positions if x["type"] == typ or (typ == StockType and x['type'] in [FeeType, AdjustmentType, RefundType, IndexAdjustmentType])])
-    income_usd = Decimal('0')
-    fees_usd = Decimal('0')
-    przychod = {}
-    koszty = {}
-    dochod = {}
-    negative_dividend_sum = Decimal('0')
-    dividends = group_by_pos_id(dividends)
-    refunds_sum_usd = Decimal('0')
-    index_adjustment_sum_usd = Decimal('0')
-
-    if unmatched_dividend_position_ids is not None:
-        for negative_dividend in [x for x in input_positions if x['type'] == DividendType and x['amount'] < 0 and x['id'] in unmatched_dividend_position_ids]:
-            # ujemne dywidendy traktujemy jako koszt, ale tylko dla niezmatchowanych wczesniej dywidend z sheetu 'Dividends'
-            pos_id = negative_dividend['id']
-            country = get_ticker_country(negative_dividend, transactions, closed_positions, dividends)
-            if country == CryptoCountry:
-                raise Exception(f"Found a rollover fee for crypto position {pos_id}. Should be marked as cfd?")
-            fee = {'id': pos_id, 'date': negative_dividend['date'], 'amount': negative_dividend['amount'], 'country': country, "type": FeeType, 'is_cfd': negative_dividend['is_cfd']}
-            positions.append(fee)
-            negative_dividend_sum -= negative_dividend['amount']
-
-    for pos in positions:
-        pos_id = pos['id']
-        country = get_ticker_country(pos, transactions, closed_positions, dividends)
-        if country not in przychod:
-            przychod[country] = Decimal("0")
-            koszty[country] = Decimal("0")
-            dochod[country] = Decimal("0")
-
-        if pos["type"] == FeeType:
-            rate_pln = convert_rate(pos["date"], pos["amount"], currency='USD', dec_places=2)
-            fees_usd += pos["amount"]
-            if rate_pln > 0:
-                # take positive fee for CFD and count it as interest profit
-                przychod[country] += rate_pln
-            else:
-                koszty[country] += -rate_pln
-        elif pos["type"] == CryptoType:
-            rate_pln = convert_rate(pos["date"], pos["amount"], currency='USD', dec_places=2)
-            if rate_pln > 0:
-                # positive, we sold crypto we bought
-                przychod[country] += rate_pln
-            else:
-                # negative, we bought crypto
-                koszty[country] += -rate_pln
-
-            income_usd += pos["equity_change"]
-        elif pos['type'] == StockType:
-            if pos['is_cfd']:
-                profit_pln = convert_rate(pos["close_date"], pos["equity_change"], currency='USD', dec_places=2)
-                if profit_pln > 0:
-                    przychod[country] += profit_pln
-                else:
-                    koszty[country] += -profit_pln
-            else:
-                open_rate_pln = convert_rate(pos["open_date"], pos["open_amount"], currency='USD', dec_places=2)
-                close_rate_pln = convert_rate(pos["close_date"], pos["close_amount"], currency='USD', dec_places=2)
-                koszty[country] += open_rate_pln
-                przychod[country] += close_rate_pln
-
-            income_usd += pos["equity_change"]
-        elif pos['type'] in [AdjustmentType, RefundType, IndexAdjustmentType]:
-            rate_pln = convert_rate(pos["date"], pos["amount"], currency='USD', dec_places=2)
-            if rate_pln > 0:
-                przychod[country] += rate_pln
-            else:
-                koszty[country] += -rate_pln
-
-            if pos['type'] in [AdjustmentType, RefundType]:
-                refunds_sum_usd += pos['amount']
-            elif pos['type'] == IndexAdjustmentType:
-                index_adjustment_sum_usd += pos['amount']
-            else:
-                raise Exception(f'Unknown {pos["type"]} for {pos_id}')
+def amount_state(amount):
+    return dict([(k, str(v)) for k, v in amount.items()]) if isinstance(amount, dict) else str(amount)
+
+def amount_from_state(state):
+    parse = int if use_fixed_point else Decimal
+    return dict([(k, parse(v)) for k, v in state.items()]) if isinstance(state, dict) else parse(state)
+
+class PositionTotals:
+    __slots__ = ('income_usd', 'fees_usd', 'przychod', 'koszty', 'negative_dividend_sum', 'refunds_sum_usd', 'index_adjustment_sum_usd', 'pending')
+    amounts = __slots__[:7]
+
+    def __init__(self):
+        self.income_usd = zero_amount()
+        self.fees_usd = zero_amount()
+        self.przychod = {}
+        self.koszty = {}
+        self.negative_dividend_sum = zero_amount()
+        self.refunds_sum_usd = zero_amount()
+        self.index_adjustment_sum_usd = zero_amount()
+        # (kind, country, date, usd) waiting for the PLN conversion, kind is split (by sign), koszt or przychod
+        self.pending = []
+
+    def add_country(self, country):
+        if country not in self.przychod:
+            self.przychod[country] = zero_amount()
+            self.koszty[country] = zero_amount()
+
+    def add_pln(self, country, pln):
+        if pln > 0:
+            self.przychod[country] += pln
         else:
-            raise Exception(f'Unknown {pos["type"]} for {pos_id}')
-
-    for country in dochod.keys():
-        dochod[country] = przychod[country] - koszty[country]
-
-    return (income_usd, fees_usd, przychod, koszty, dochod, negative_dividend_sum, refunds_sum_usd, index_adjustment_sum_usd)
-
-def process_dividends(incomes, dividend_taxes):
-    dividends = [x for x in incomes if x["type"] in [DividendType, InterestType]]
-    sum_from_dividend_taxes = sum([item["Net Dividend Received (USD)"] for sublist in dividend_taxes.values() for item in sublist])
-    unmatched_dividend_position_ids = set()
-
-    income_dividends_usd = Decimal("0")
-    income_dividends_usd2 = Decimal("0")
-    income_dividends_usd_brutto = Decimal("0")
-    interest_sum_usd = Decimal('0')
-    przychod_dywidendy = Decimal("0")
-    podatek_nalezny_dywidendy = Decimal("0")
-    podatek_zaplacony_dywidendy = Decimal("0")
-
-    for dividend in dividends:
-        pos_id = dividend["id"]
-        total_usd = dividend["amount"]
-
-        if dividend['type'] == InterestType:
-            interest_sum_usd += total_usd
-            total_pln = convert_rate(dividend["date"], total_usd, currency='USD', dec_places=2)
-            przychod_dywidendy += total_pln
-            podatek_nalezny_dywidendy += round(tax_rate * total_pln, 2)
-            continue
-        elif dividend['type'] != DividendType:
-            raise Exception("unexpected dividend type")
-
-        if pos_id not in dividend_taxes:
-            unmatched_dividend_position_ids.add(pos_id)
-            continue
-
-        income_dividends_usd += total_usd
-        dividend_tax = next((x for x in dividend_taxes[pos_id] if x["Net Dividend Received (USD)"] == total_usd and x["Date of Payment"].date()== dividend["date"].date()), None)
-        if dividend_tax is None:
-            raise Exception(f"Unable to match dividend for {pos_id} amount {total_usd} on {dividend['date']}")
-
-        dividend_taxes[pos_id].remove(dividend_tax)
-        if len(dividend_taxes[pos_id]) == 0:
-            del dividend_taxes[pos_id]
+            self.koszty[country] += -pln
+
+    def merge(self, other):
+        for name in ['income_usd', 'fees_usd', 'negative_dividend_sum', 'refunds_sum_usd', 'index_adjustment_sum_usd']:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for country in other.przychod.keys():
+            self.add_country(country)
+            self.przychod[country] += other.przychod[country]
+            self.koszty[country] += other.koszty[country]
+
+    def reorder(self, countries):
+        # merged positions add countries in position order, a full run adds them in row order
+        order = [x for x in dict.fromkeys(countries) if x in self.przychod] + [x for x in self.przychod.keys() if x not in countries]
+        self.przychod = dict([(x, self.przychod[x]) for x in order])
+        self.koszty = dict([(x, self.koszty[x]) for x in order])
+
+    def relabel(self, countries):
+        # placeholder keys of the streaming mode are replaced with their countries, keeping the first seen order
+        res = PositionTotals()
+        for name in ['income_usd', 'fees_usd', 'negative_dividend_sum', 'refunds_sum_usd', 'index_adjustment_sum_usd']:
+            setattr(res, name, getattr(self, name))
+        for key in self.przychod.keys():
+            country = countries.get(key, key)
+            res.add_country(country)
+            res.przychod[country] += self.przychod[key]
+            res.koszty[country] += self.koszty[key]
+        return res
+
+    def state(self):
+        return dict([(name, amount_state(getattr(self, name))) for name in self.amounts])
+
+    def load(self, state):
+        for name in self.amounts:
+            setattr(self, name, amount_from_state(state[name]))
+        return self
+
+    def result(self):
+        dochod = dict([(country, self.przychod[country] - self.koszty[country]) for country in self.przychod.keys()])
+        przychod, koszty, dochod = [dict([(k, output_amount(v)) for k, v in x.items()]) for x in [self.przychod, self.koszty, dochod]]
+        return (output_amount(self.income_usd), output_amount(self.fees_usd), przychod, koszty, dochod, output_amount(self.negative_dividend_sum), output_amount(self.refunds_sum_usd), output_amount(self.index_adjustment_sum_usd))
+
+def add_position(totals, pos, country):
+    pos_id = pos.id
+    totals.add_country(country)
+
+    if pos.type == FeeType:
+        totals.fees_usd += pos.amount
+        # positive fee for CFD is counted as interest profit
+        totals.pending.append(('split', country, pos.date, pos.amount))
+    elif pos.type == CryptoType:
+        # positive, we sold crypto we bought. negative, we bought crypto
+        totals.pending.append(('split', country, pos.date, pos.amount))
+        totals.income_usd += pos.equity_change
+    elif pos.type == StockType:
+        if pos.is_cfd:
+            totals.pending.append(('split', country, pos.close_date, pos.equity_change))
+        else:
+            totals.pending.append(('koszt', country, pos.open_date, pos.open_amount))
+            totals.pending.append(('przychod', country, pos.close_date, pos.close_amount))
 
-        income_dividends_usd2 += dividend_tax["Net Dividend Received (USD)"]
-        witholding_tax_rate = dividend_tax["Withholding Tax Rate (%)"]
-        total_usd = dividend_tax["Withholding Tax Amount (USD)"] + dividend_tax["Net Dividend Received (USD)"]
-        income_dividends_usd_brutto += total_usd
+        totals.income_usd += pos.equity_change
+    elif pos.type in [AdjustmentType, RefundType, IndexAdjustmentType]:
+        totals.pending.append(('split', country, pos.date, pos.amount))
 
-        total_pln = convert_rate(dividend["date"], total_usd, currency='USD', dec_places=2)
-        przychod_dywidendy += total_pln
-        podatek_zaplacony_dywidendy += round(witholding_tax_rate * total_pln, 2)
+        if pos.type in [AdjustmentType, RefundType]:
+            totals.refunds_sum_usd += pos.amount
+        elif pos.type == IndexAdjustmentType:
+            totals.index_adjustment_sum_usd += pos.amount
+        else:
+            raise Exception(f'Unknown {pos.type} for {pos_id}')
+    else:
+        raise Exception(f'Unknown {pos.type} for {pos_id}')
+
+def pln_from_cents(cents):
+    return cents if use_fixed_point else to_decimal(cents)
+
+def convert_positions(totals):
+    converted = None
+    if engine == 'numpy' and len(totals.pending) > 0:
+        import vectorized
+        converted = vectorized.convert_positions(totals.pending, list(totals.przychod.keys()))
+
+    if converted is not None:
+        for country, przychod, przychod_rows, koszty, koszty_rows in converted:
+            if przychod_rows > 0:
+                totals.przychod[country] += pln_from_cents(przychod)
+            if koszty_rows > 0:
+                totals.koszty[country] += pln_from_cents(koszty)
+    else:
+        for kind, country, date, amount in totals.pending:
+            rate_pln = to_pln(date, amount)
+            if kind == 'split':
+                totals.add_pln(country, rate_pln)
+            elif kind == 'koszt':
+                totals.koszty[country] += rate_pln
+            else:
+                totals.przychod[country] += rate_pln
+    totals.pending = []
 
-        if tax_rate - witholding_tax_rate > 0:
-            podatek_nalezny_dywidendy += round(tax_rate * total_pln, 2)
+def process_positions(input_positions, unmatched_dividend_position_ids, transactions, closed_positions, dividends):
+    dividends = group_by_pos_id(dividends)
+    prefetch_ticker_countries(input_positions, transactions, closed_positions, dividends)
+    stock, crypto = accumulate_positions(input_positions, unmatched_dividend_position_ids, transactions, closed_positions, dividends, {})
+    return (stock.result(), crypto.result())
+
+def accumulate_positions(input_positions, unmatched_dividend_position_ids, transactions, closed_positions, dividends, countries):
+    # one pass for both stock and crypto, the country of a position is resolved once per run
+    stock = PositionTotals()
+    crypto = PositionTotals()
+
+    for pos in input_positions:
+        if pos.type == CryptoType:
+            totals = crypto
+        elif pos.type in [StockType, FeeType, AdjustmentType, RefundType, IndexAdjustmentType]:
+            totals = stock
         else:
-            podatek_nalezny_dywidendy += round(witholding_tax_rate * total_pln, 2)
+            continue
+        add_position(totals, pos, get_ticker_country(pos, transactions, closed_positions, dividends, countries))
+
+    for negative_dividend in [x for x in input_positions if x.type == DividendType and x.amount < 0 and x.id in unmatched_dividend_position_ids]:
+        # ujemne dywidendy traktujemy jako koszt, ale tylko dla niezmatchowanych wczesniej dywidend z sheetu 'Dividends'
+        pos_id = negative_dividend.id
+        country = get_ticker_country(negative_dividend, transactions, closed_positions, dividends, countries)
+        if country == CryptoCountry:
+            raise Exception(f"Found a rollover fee for crypto position {pos_id}. Should be marked as cfd?")
+        fee = Entry(pos_id, FeeType, date=negative_dividend.date, amount=negative_dividend.amount, is_cfd=negative_dividend.is_cfd)
+        add_position(stock, fee, get_ticker_country(fee, transactions, closed_positions, dividends, countries))
+        stock.negative_dividend_sum -= negative_dividend.amount
+
+    convert_positions(stock)
+    convert_positions(crypto)
+    return (stock, crypto)
+
+def stock_countries(input_positions, unmatched_dividend_position_ids, countries):
+    # countries in the order a full run of accumulate_positions adds them to the stock totals
+    order = []
+    for pos in input_positions:
+        if pos.type in [StockType, FeeType, AdjustmentType, RefundType, IndexAdjustmentType]:
+            order.append(CfdCountry if pos.is_cfd else countries.get(pos.id))
+    for pos in input_positions:
+        if pos.type == DividendType and pos.amount < 0 and pos.id in unmatched_dividend_position_ids:
+            order.append(CfdCountry if pos.is_cfd else countries.get(pos.id))
+    return order
+
+def dividend_tax_key(pos_id, net, date):
+    return (pos_id, net, date.date())
+
+def index_dividend_taxes(dividend_taxes):
+    # multiset of withholding tax rows, rows with the same key are kept in sheet order
+    index = {}
+    for pos_id, taxes in dividend_taxes.items():
+        for x in taxes:
+            key = dividend_tax_key(pos_id, x["Net Dividend Received (USD)"], x["Date of Payment"])
+            if key not in index:
+                index[key] = []
+            index[key].append(x)
+    for rows in index.values():
+        rows.reverse()
+    return index
+
+def unmatched_dividend_taxes(dividend_taxes, matched):
+    leftovers = [(pos_id, [x for x in taxes if id(x) not in matched]) for pos_id, taxes in dividend_taxes.items()]
+    return dict([(pos_id, taxes) for pos_id, taxes in leftovers if len(taxes) > 0])
+
+class DividendTotals:
+    __slots__ = ('income_dividends_usd', 'income_dividends_usd2', 'income_dividends_usd_brutto', 'interest_sum_usd', 'przychod_dywidendy', 'podatek_nalezny_dywidendy', 'podatek_zaplacony_dywidendy', 'unmatched_dividend_position_ids', 'remaining', 'matched', 'pending', 'index')
+    amounts = __slots__[:7]
+
+    def __init__(self):
+        for name in self.amounts:
+            setattr(self, name, zero_amount())
+        self.unmatched_dividend_position_ids = set()
+        self.remaining = {}
+        self.matched = set()
+        # (date, usd, podatek nalezny rate, podatek zaplacony rate) waiting for the PLN conversion
+        self.pending = []
+        self.index = {}
+
+    def track(self, dividend_taxes):
+        self.index = index_dividend_taxes(dividend_taxes)
+        self.remaining = dict([(pos_id, len(taxes)) for pos_id, taxes in dividend_taxes.items()])
+        return self
+
+    def merge(self, other):
+        for name in self.amounts:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.unmatched_dividend_position_ids |= other.unmatched_dividend_position_ids
+        self.remaining.update(other.remaining)
+
+    def state(self):
+        return dict([(name, amount_state(getattr(self, name))) for name in self.amounts])
+
+    def load(self, state):
+        for name in self.amounts:
+            setattr(self, name, amount_from_state(state[name]))
+        return self
+
+    def result(self):
+        podstawa_dywidendy = round_total(self.przychod_dywidendy)
+        podatek_nalezny_dywidendy = round_total(self.podatek_nalezny_dywidendy)
+        podatek_zaplacony_dywidendy = round_total(self.podatek_zaplacony_dywidendy)
+        return (output_amount(self.income_dividends_usd), output_amount(self.income_dividends_usd_brutto), output_amount(self.przychod_dywidendy), podstawa_dywidendy, podatek_nalezny_dywidendy, podatek_zaplacony_dywidendy, self.unmatched_dividend_position_ids, output_amount(self.interest_sum_usd))
+
+def match_dividends(incomes, dividend_taxes):
+    dividends = [x for x in incomes if x.type in [DividendType, InterestType]]
+    totals = DividendTotals().track(dividend_taxes)
 
-    # validate
-    if sum_from_dividend_taxes != income_dividends_usd:
-        for pos_id, tax in dividend_taxes.items():
+    for dividend in dividends:
+        match_dividend(totals, dividend)
+
+    convert_dividends(totals)
+    return totals
+
+def match_dividend(totals, dividend):
+    pos_id = dividend.id
+    total_usd = dividend.amount
+
+    if dividend.type == InterestType:
+        totals.interest_sum_usd += total_usd
+        totals.pending.append((dividend.date, total_usd, tax_rate, None))
+        return
+    elif dividend.type != DividendType:
+        raise Exception("unexpected dividend type")
+
+    if totals.remaining.get(pos_id, 0) == 0:
+        totals.unmatched_dividend_position_ids.add(pos_id)
+        return
+
+    totals.income_dividends_usd += total_usd
+    candidates = totals.index.get(dividend_tax_key(pos_id, total_usd, dividend.date))
+    if not candidates:
+        raise Exception(f"Unable to match dividend for {pos_id} amount {total_usd} on {dividend.date}")
+
+    dividend_tax = candidates.pop()
+    totals.matched.add(id(dividend_tax))
+    totals.remaining[pos_id] -= 1
+
+    totals.income_dividends_usd2 += dividend_tax["Net Dividend Received (USD)"]
+    witholding_tax_rate = dividend_tax["Withholding Tax Rate (%)"]
+    total_usd = dividend_tax["Withholding Tax Amount (USD)"] + dividend_tax["Net Dividend Received (USD)"]
+    totals.income_dividends_usd_brutto += total_usd
+
+    nalezny_rate = tax_rate if tax_rate - witholding_tax_rate > 0 else witholding_tax_rate
+    totals.pending.append((dividend.date, total_usd, nalezny_rate, witholding_tax_rate))
+
+def convert_dividends(totals):
+    converted = None
+    if engine == 'numpy' and len(totals.pending) > 0:
+        import vectorized
+        converted = vectorized.convert_dividends(totals.pending)
+
+    if converted is not None:
+        przychod, nalezny, zaplacony, has_zaplacony = converted
+        totals.przychod_dywidendy += pln_from_cents(przychod)
+        totals.podatek_nalezny_dywidendy += pln_from_cents(nalezny)
+        if has_zaplacony:
+            totals.podatek_zaplacony_dywidendy += pln_from_cents(zaplacony)
+    else:
+        for date, total_usd, nalezny_rate, zaplacony_rate in totals.pending:
+            total_pln = to_pln(date, total_usd)
+            totals.przychod_dywidendy += total_pln
+            if zaplacony_rate is not None:
+                totals.podatek_zaplacony_dywidendy += apply_rate(zaplacony_rate, total_pln)
+            totals.podatek_nalezny_dywidendy += apply_rate(nalezny_rate, total_pln)
+    totals.pending = []
+
+def dividend_taxes_sum(dividend_taxes):
+    return sum([item["Net Dividend Received (USD)"] for sublist in dividend_taxes.values() for item in sublist])
+
+def dividends_valid(dividend_taxes, totals):
+    return dividend_taxes_sum(dividend_taxes) == totals.income_dividends_usd and not any(x > 0 for x in totals.remaining.values())
+
+def validate_dividends(dividend_taxes, totals):
+    if dividend_taxes_sum(dividend_taxes) != totals.income_dividends_usd:
+        for pos_id, tax in unmatched_dividend_taxes(dividend_taxes, totals.matched).items():
             print(f'Pos id: {pos_id} {tax}')
         raise Exception("Suma dywidend między Dywidendy i Transaction Report się nie zgadza. Prawdopodobnie negatywne dywidendy (adjustmenty przez etoro). Zweryfikuj transakcje i manualnie zrób reconciliation w excelu.")
 
-    if len(dividend_taxes) != 0:
+    if any(x > 0 for x in totals.remaining.values()):
         raise Exception("Niewykorzystano wszystkich dywidend do rozdzielenia podatku!")
 
-    income_dividends_usd = income_dividends_usd
-    income_dividends_usd_brutto = income_dividends_usd_brutto
-    przychod_dywidendy = przychod_dywidendy
-    podstawa_dywidendy = round(przychod_dywidendy)
-    podatek_nalezny_dywidendy = round(podatek_nalezny_dywidendy)
-    podatek_zaplacony_dywidendy = round(podatek_zaplacony_dywidendy)
-    return (income_dividends_usd, income_dividends_usd_brutto, przychod_dywidendy, podstawa_dywidendy, podatek_nalezny_dywidendy, podatek_zaplacony_dywidendy, unmatched_dividend_position_ids, interest_sum_usd)
+def process_dividends(incomes, dividend_taxes):
+    totals = match_dividends(incomes, dividend_taxes)
+    validate_dividends(dividend_taxes, totals)
+    return totals.result()
+
+def entry_dates(entries):
+    return [date for x in entries for date in [x.date, x.open_date, x.close_date] if date is not None]
 
-def do_checks(fname, income_dividends_usd, income_stock_usd, fees_stock_usd, negative_dividends, income_crypto_usd, fees_crypto_usd, refunds_sum_usd, interest_sum_usd, index_adjustments_sum_usd):
-    stock_sum, crypto_sum, dividends_sum, fees_sum, interest_sum, refunds_sum, index_adjustments_sum = read_summary(fname)
+def group_entries(entries):
+    res = {}
+    for x in entries:
+        if x.id not in res:
+            res[x.id] = []
+        res[x.id].append(x)
+    return res
+
+def t2_settings():
+    # the calendar moves the settlement dates and so the rates of stock positions
+    return {'use_t_plus_2': use_t_plus_2, 't2_calendar': t2_calendar, 't2_extra_holidays': sorted([x.isoformat() for x in business_days.extra_holidays.get(t2_calendar, [])])}
+
+def checkpoint_settings():
+    return {'version': checkpoint_version, 'year': year, **t2_settings(), 'use_fixed_point': use_fixed_point, 'tax_rate': str(tax_rate)}
+
+class CheckpointMismatch(Exception):
+    # the positions taken from the checkpoint don't add up for this statement, a full run gives the real errors
+    pass
+
+def read_checkpoint():
+    # other settings or a missing file mean every position is recomputed, an unreadable file too but with a warning
+    if not os.path.exists(checkpoint_path):
+        return {}
+    try:
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        positions = checkpoint['positions'] if checkpoint.get('settings') == checkpoint_settings() else {}
+        if not isinstance(positions, dict):
+            raise ValueError('positions is not an object')
+        return positions
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        print(f'WARNING: Ignoring unreadable checkpoint {checkpoint_path}: {e}')
+        return {}
+
+def write_checkpoint(positions):
+    try:
+        with open(checkpoint_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'settings': checkpoint_settings(), 'positions': positions}, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+    except OSError as e:
+        print(f'WARNING: Unable to write checkpoint {checkpoint_path}: {e}')
+
+def position_fingerprint(pos_id, transactions, closed_positions, dividends):
+    rows = [transactions.get(pos_id, []), closed_positions.get(pos_id, []), dividends.get(pos_id, [])]
+    return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+
+def aggregate(entries, dividend_taxes, transactions, closed_positions, raw_dividends):
+    dividends = process_dividends(entries, dividend_taxes)
+    stock, crypto = process_positions(entries, dividends[6], transactions, closed_positions, raw_dividends)
+    return (dividends, stock, crypto)
+
+def aggregate_incremental(entries, dividend_taxes, transactions, closed_positions, raw_dividends):
+    # every position only depends on its own rows, so its totals can be reused while the rows stay the same
+    dividends = group_by_pos_id(raw_dividends)
+    stored = read_checkpoint()
+    positions = group_entries(entries)
+    fingerprints = dict([(pos_id, position_fingerprint(pos_id, transactions, closed_positions, dividends)) for pos_id in positions.keys()])
+    changed = set([pos_id for pos_id in positions.keys() if stored.get(str(pos_id), {}).get('fingerprint') != fingerprints[pos_id]])
+    count('positions_reused', len(positions) - len(changed))
+    prefetch_ticker_countries([x for pos_id in changed for x in positions[pos_id]], transactions, closed_positions, dividends)
+
+    dividend_totals = DividendTotals()
+    dividend_totals.remaining = dict([(pos_id, len(taxes)) for pos_id, taxes in dividend_taxes.items()])
+    stock = PositionTotals()
+    crypto = PositionTotals()
+    countries = {}
+    checkpoint = {}
+    for pos_id, pos_entries in positions.items():
+        if pos_id in changed:
+            pos_dividends = match_dividends(pos_entries, dict([(pos_id, dividend_taxes[pos_id])]) if pos_id in dividend_taxes else {})
+            pos_stock, pos_crypto = accumulate_positions(pos_entries, pos_dividends.unmatched_dividend_position_ids, transactions, closed_positions, dividends, countries)
+            state = {
+                'fingerprint': fingerprints[pos_id],
+                'country': countries.get(pos_id),
+                'unmatched': pos_id in pos_dividends.unmatched_dividend_position_ids,
+                'remaining': pos_dividends.remaining.get(pos_id, 0),
+                'dividends': pos_dividends.state(),
+                'stock': pos_stock.state(),
+                'crypto': pos_crypto.state()
+            }
+        else:
+            state = stored[str(pos_id)]
+            pos_dividends = DividendTotals().load(state['dividends'])
+            pos_stock = PositionTotals().load(state['stock'])
+            pos_crypto = PositionTotals().load(state['crypto'])
+            if state['unmatched']:
+                pos_dividends.unmatched_dividend_position_ids.add(pos_id)
+            if pos_id in dividend_taxes:
+                pos_dividends.remaining[pos_id] = state['remaining']
+            if state['country'] is not None:
+                countries[pos_id] = state['country']
+
+        dividend_totals.merge(pos_dividends)
+        stock.merge(pos_stock)
+        crypto.merge(pos_crypto)
+        checkpoint[str(pos_id)] = state
+
+    if not dividends_valid(dividend_taxes, dividend_totals):
+        raise CheckpointMismatch('Dividends from the checkpoint do not reconcile')
+    stock.reorder(stock_countries(entries, dividend_totals.unmatched_dividend_position_ids, countries))
+    write_checkpoint(checkpoint)
+    return (dividend_totals.result(), stock.result(), crypto.result())
+
+def track_activity(rows, symbols, closed_activity):
+    # keeps what get_ticker_names and check_closed_positions need from the rows passing by
+    for row in rows:
+        pos_id = row['Position ID']
+        if row['Type'] in ['Position closed', 'Open Position', 'Dividend'] and pos_id not in symbols:
+            symbols[pos_id] = row['Details']
+        if row['Type'] == 'Position closed':
+            closed_activity.add(pos_id)
+        yield row
+
+def aggregate_stream(statement):
+    # Closed Positions and Dividends are indexed first, then Account Activity flows through parsing, matching and conversion
+    closed_positions = group_by_pos_id(statement.stream('Closed Positions', closed_position_columns))
+    dividend_taxes, raw_dividends = read_dividend_taxes(statement)
+    dividends = group_by_pos_id(raw_dividends)
+    dividend_totals = DividendTotals().track(dividend_taxes)
+    stock = PositionTotals()
+    crypto = PositionTotals()
+    negative_dividends = []
+    symbols = {}
+    closed_activity = set()
+
+    rows = track_activity(statement.stream('Account Activity', activity_columns), symbols, closed_activity)
+    for idx, pos in enumerate(parse_activity(rows, closed_positions)):
+        if pos.type in [DividendType, InterestType]:
+            match_dividend(dividend_totals, pos)
+            if pos.type == DividendType and pos.amount < 0:
+                negative_dividends.append(pos)
+        elif pos.type == CryptoType:
+            add_position(crypto, pos, CryptoCountry)
+        elif pos.type in [StockType, FeeType, AdjustmentType, RefundType, IndexAdjustmentType]:
+            # stock countries are resolved once all rows were read
+            add_position(stock, pos, get_direct_country(pos) or ('stock', pos.id))
+        if (idx + 1) % stream_flush_rows == 0:
+            convert_positions(stock)
+            convert_positions(crypto)
+            convert_dividends(dividend_totals)
+
+    check_closed_positions([x for rows in closed_positions.values() for x in rows], lambda pos_id: pos_id in closed_activity)
+    convert_dividends(dividend_totals)
+    validate_dividends(dividend_taxes, dividend_totals)
+
+    fees = PositionTotals()
+    for negative_dividend in [x for x in negative_dividends if x.id in dividend_totals.unmatched_dividend_position_ids]:
+        # ujemne dywidendy traktujemy jako koszt, ale tylko dla niezmatchowanych wczesniej dywidend z sheetu 'Dividends'
+        pos_id = negative_dividend.id
+        if get_direct_country(negative_dividend) == CryptoCountry:
+            raise Exception(f"Found a rollover fee for crypto position {pos_id}. Should be marked as cfd?")
+        fee = Entry(pos_id, FeeType, date=negative_dividend.date, amount=negative_dividend.amount, is_cfd=negative_dividend.is_cfd)
+        add_position(fees, fee, get_direct_country(fee) or ('stock', pos_id))
+        fees.negative_dividend_sum -= negative_dividend.amount
+    for totals in [stock, crypto, fees]:
+        convert_positions(totals)
+
+    pos_ids = [key[1] for totals in [stock, fees] for key in totals.przychod.keys() if isinstance(key, tuple)]
+    names = {}
+    for pos_id in pos_ids:
+        if pos_id not in symbols:
+            raise Exception(f'Logic error. Unable to find position {pos_id} in transactions sheet')
+        stock_name = closed_positions[pos_id][0]["Action"] if pos_id in closed_positions else (dividends[pos_id][0]["Instrument Name"] if pos_id in dividends else None)
+        names[pos_id] = (stock_name, symbols[pos_id])
+    with stage('country_mapping'):
+        prefetch_country_codes(list(names.values()))
+        countries = dict([(('stock', pos_id), get_country_code(*names[pos_id])) for pos_id in pos_ids])
+
+    stock = stock.relabel(countries)
+    stock.merge(fees.relabel(countries))
+    return (dividend_totals.result(), stock.result(), crypto.result())
+
+def do_checks(statement, income_dividends_usd, income_stock_usd, fees_stock_usd, negative_dividends, income_crypto_usd, fees_crypto_usd, refunds_sum_usd, interest_sum_usd, index_adjustments_sum_usd):
+    stock_sum, crypto_sum, dividends_sum, fees_sum, interest_sum, refunds_sum, index_adjustments_sum = read_summary(statement)
     warnings = []
 
     if income_dividends_usd != dividends_sum:
@@ -482,51 +904,127 @@ def do_checks(fname, income_dividends_usd, income_stock_usd, fees_stock_usd, neg
     if index_adjustments_sum_usd != index_adjustments_sum:
         warnings += [f'Incorrect index adjustment sum. Expected ${index_adjustments_sum} got ${index_adjustments_sum_usd}']
 
+    return warnings
+
+def aggregate_statement(statement):
+    with stage('parse'):
+        entries, grouped_transactions, grouped_closed_positions = read(statement)
+        dividend_taxes, raw_dividends = read_dividend_taxes(statement)
+    prefetch_rates(rate_tables_needed(entry_dates(entries), 'USD'))
+
+    with stage('aggregation'):
+        result = None
+        if checkpoint_path is not None:
+            try:
+                result = aggregate_incremental(entries, dividend_taxes, grouped_transactions, grouped_closed_positions, raw_dividends)
+            except CheckpointMismatch:
+                # a full run raises the same errors and prints the same diagnostics as without a checkpoint
+                result = None
+        if result is None:
+            result = aggregate(entries, dividend_taxes, grouped_transactions, grouped_closed_positions, raw_dividends)
+    return result
+
+def calculate(fname):
+    settings = {'year': year, **t2_settings(), 'use_fixed_point': use_fixed_point, 'tax_rate': str(tax_rate)}
+    return result_cache.cached('etoro', [fname], settings, lambda: calculate_statement(fname))
+
+def aggregate_any(statement):
+    if streaming:
+        with stage('aggregation'):
+            return aggregate_stream(statement)
+    return aggregate_statement(statement)
+
+def aggregate_decimals(statement):
+    # amounts below a cent don't fit fixed point, the statement is read again and aggregated like without it
+    global use_fixed_point
+    statement.sheets = {}
+    use_fixed_point = False
+    try:
+        return aggregate_any(statement)
+    finally:
+        use_fixed_point = True
+
+def calculate_statement(fname):
+    # the workbook is closed whatever happens, batch workers run many statements
+    with Statement(fname) as statement:
+        try:
+            result = aggregate_any(statement)
+        except SubCentAmount:
+            result = aggregate_decimals(statement)
+        dividends, stock, crypto = result
+        income_dividends_usd, income_dividends_usd_brutto, przychod_dywidendy, podstawa_dywidendy, podatek_nalezny_dywidendy, podatek_zaplacony_dywidendy, unmatched_dividend_position_ids, interest_sum_usd = dividends
+        income_stock_usd, fees_stock_usd, przychod_stock, koszty_stock, dochod_stock, negative_dividend_sum, refunds_sum_usd, index_adjustment_sum_usd = stock
+        income_crypto_usd, fees_crypto_usd, przychod_crypto, koszty_crypto, dochod_crypto, _, _, _ = crypto
+
+        with stage('reconciliation'):
+            warnings = do_checks(statement, income_dividends_usd, income_stock_usd, fees_stock_usd, negative_dividend_sum, income_crypto_usd, fees_crypto_usd, refunds_sum_usd, interest_sum_usd, index_adjustment_sum_usd)
+
+    return {
+        'income_dividends_usd': income_dividends_usd,
+        'interest_sum_usd': interest_sum_usd,
+        'income_dividends_usd_brutto': income_dividends_usd_brutto,
+        'przychod_dywidendy': przychod_dywidendy,
+        'podstawa_dywidendy': podstawa_dywidendy,
+        'podatek_nalezny_dywidendy': podatek_nalezny_dywidendy,
+        'podatek_zaplacony_dywidendy': podatek_zaplacony_dywidendy,
+        'podatek_do_zaplaty_dywidendy': podatek_nalezny_dywidendy - podatek_zaplacony_dywidendy,
+        'income_stock_usd': income_stock_usd,
+        'fees_stock_usd': fees_stock_usd,
+        'negative_dividend_sum': negative_dividend_sum,
+        'przychod_stock': sum_dict(przychod_stock),
+        'koszty_stock': sum_dict(koszty_stock),
+        'dochod_stock': sum_dict(dochod_stock),
+        'podatek_stock': max(round(sum_dict(dochod_stock) * tax_rate), 0),
+        'dochod_stock_per_country': dochod_stock,
+        'income_crypto_usd': income_crypto_usd,
+        'fees_crypto_usd': fees_crypto_usd,
+        'przychod_crypto': sum_dict(przychod_crypto),
+        'koszty_crypto': sum_dict(koszty_crypto),
+        'dochod_crypto': sum_dict(dochod_crypto),
+        'podatek_crypto': max(round(sum_dict(dochod_crypto) * tax_rate), 0),
+        'warnings': warnings
+    }
+
+def main(fname):
+    r = calculate(fname)
+    print()
+    print("Dywidendy na PIT-38 sekcja G (podatek poza granicami pln)")
+    print(f"Przychód $ za dywidendy ${r['income_dividends_usd']} (w summary 'Stock and ETF Dividends (Profit)' + 'CFD Dividends (Profit or Loss)')")
+    print(f"Przychód $ etoro interest ${r['interest_sum_usd']}")
+    print(f"Przychód $ za dywidendy brutto ${r['income_dividends_usd_brutto']}")
+    print(f"Przychód w pln za dywidendy: {r['przychod_dywidendy']} zł")
+    print(f"Podstawa w pln za dywidendy: {r['podstawa_dywidendy']} zł")
+    print(f"Podatek należny: {r['podatek_nalezny_dywidendy']} zł")
+    print(f"Podatek zapłacony za granicą: {r['podatek_zaplacony_dywidendy']} zł")
+    print(f"Podatek za dywidendy: {r['podatek_do_zaplaty_dywidendy']} zł")
+
+    print()
+    print("Stocks na Pit-38 sekcja C jako inne przychody. Koniecznie z załącznikiem PIT/ZG")
+    print(f"Dochód $ za stocks: ${r['income_stock_usd']} (w summary suma 'CFDs (Profit or Loss)' + 'Stocks (Profit or Loss)' + 'ETFs (Profit or Loss)')")
+    print(f"Koszty $ za stocks: ${r['fees_stock_usd']} (w tym negatywne dywidendy: ${r['negative_dividend_sum']}) (w summary suma 'Fees' + 'SDRT Charge' - te negatywne dywidendy czyli ${r['fees_stock_usd'] + r['negative_dividend_sum']})")
+    print(f"Przychód w pln za stocks: {r['przychod_stock']} zł")
+    print(f"Koszt w pln za stocks: {r['koszty_stock']} zł")
+    print(f"Dochód w pln za stocks: {r['dochod_stock']} zł")
+    print(f"Podatek: {r['podatek_stock']} zł")
+    print(f"Dochód per kraj (zawiera tylko dodatnie): {dict([(x, str(y)) for x, y in r['dochod_stock_per_country'].items() if y > 0])}")
+
+    print()
+    print("Crypto rozliczamy na PIT-38 sekcja E")
+    print(f"Dochód $ za crypto: ${r['income_crypto_usd']} (w summary 'Crypto (Profit or Loss)')")
+    print(f"Koszty $ za crypto: ${r['fees_crypto_usd']} (powinno być zawsze zero)")
+    print(f"Przychód w pln za crypto: {r['przychod_crypto']} zł")
+    print(f"Koszt w pln za crypto: {r['koszty_crypto']} zł")
+    print(f"Dochód w pln za crypto: {r['dochod_crypto']} zł")
+    print(f"Podatek: {r['podatek_crypto']} zł")
+
     print()
     print("-------------------------IMPORTANT----------------------------")
-    if len(warnings) == 0:
+    if len(r['warnings']) == 0:
         print("Congratulations! All checks with the 'Financial Summary sheet' passed!")
     else:
-        [print(x) for x in warnings]
+        [print(x) for x in r['warnings']]
     print("-------------------------IMPORTANT----------------------------")
     print()
 
-fname = 'statement_2024.xlsx'
-entries, grouped_transactions, grouped_closed_positions = read(fname)
-dividend_taxes, raw_dividends = read_dividend_taxes(fname)
-
-income_dividends_usd, income_dividends_usd_brutto, przychod_dywidendy, podstawa_dywidendy, podatek_nalezny_dywidendy, podatek_zaplacony_dywidendy, unmatched_dividend_position_ids, interest_sum_usd = process_dividends(entries, dividend_taxes)
-podatek_do_zaplaty_dywidendy = podatek_nalezny_dywidendy - podatek_zaplacony_dywidendy
-print()
-print("Dywidendy na PIT-38 sekcja G (podatek poza granicami pln)")
-print(f"Przychód $ za dywidendy ${income_dividends_usd} (w summary 'Stock and ETF Dividends (Profit)' + 'CFD Dividends (Profit or Loss)')")
-print(f"Przychód $ etoro interest ${interest_sum_usd}")
-print(f"Przychód $ za dywidendy brutto ${income_dividends_usd_brutto}")
-print(f"Przychód w pln za dywidendy: {przychod_dywidendy} zł")
-print(f"Podstawa w pln za dywidendy: {podstawa_dywidendy} zł")
-print(f"Podatek należny: {podatek_nalezny_dywidendy} zł")
-print(f"Podatek zapłacony za granicą: {podatek_zaplacony_dywidendy} zł")
-print(f"Podatek za dywidendy: {podatek_do_zaplaty_dywidendy} zł")
-
-income_stock_usd, fees_stock_usd, przychod_stock, koszty_stock, dochod_stock, negative_dividend_sum, refunds_sum_usd, index_adjustment_sum_usd = process_positions(entries, StockType, unmatched_dividend_position_ids, grouped_transactions, grouped_closed_positions, raw_dividends)
-print()
-print("Stocks na Pit-38 sekcja C jako inne przychody. Koniecznie z załącznikiem PIT/ZG")
-print(f"Dochód $ za stocks: ${income_stock_usd} (w summary suma 'CFDs (Profit or Loss)' + 'Stocks (Profit or Loss)' + 'ETFs (Profit or Loss)')")
-print(f"Koszty $ za stocks: ${fees_stock_usd} (w tym negatywne dywidendy: ${negative_dividend_sum}) (w summary suma 'Fees' + 'SDRT Charge' - te negatywne dywidendy czyli ${fees_stock_usd+negative_dividend_sum})")
-print(f"Przychód w pln za stocks: {sum_dict(przychod_stock)} zł")
-print(f"Koszt w pln za stocks: {sum_dict(koszty_stock)} zł")
-print(f"Dochód w pln za stocks: {sum_dict(dochod_stock)} zł")
-print(f"Podatek: {max(round(sum_dict(dochod_stock) * tax_rate), 0)} zł")
-print(f'Dochód per kraj (zawiera tylko dodatnie): {dict([(x, str(y)) for x, y in dochod_stock.items() if y > 0])}')
-
-income_crypto_usd, fees_crypto_usd, przychod_crypto, koszty_crypto, dochod_crypto, _, _, _ = process_positions(entries, CryptoType, None, grouped_transactions, grouped_closed_positions, raw_dividends)
-print()
-print("Crypto rozliczamy na PIT-38 sekcja E")
-print(f"Dochód $ za crypto: ${income_crypto_usd} (w summary 'Crypto (Profit or Loss)')")
-print(f"Koszty $ za crypto: ${fees_crypto_usd} (powinno być zawsze zero)")
-print(f"Przychód w pln za crypto: {sum_dict(przychod_crypto)} zł")
-print(f"Koszt w pln za crypto: {sum_dict(koszty_crypto)} zł")
-print(f"Dochód w pln za crypto: {sum_dict(dochod_crypto)} zł")
-print(f"Podatek: {max(round(sum_dict(dochod_crypto) * tax_rate), 0)} zł")
-
-do_checks(fname, income_dividends_usd, income_stock_usd, fees_stock_usd, negative_dividend_sum, income_crypto_usd, fees_crypto_usd, refunds_sum_usd, interest_sum_usd, index_adjustment_sum_usd)
\ No newline at end of file
+if __name__ == '__main__':
+    main('statement_2024.xlsx')
\ No newline at end of file
@@ -1,4 +1,8 @@
-import requests, json, re
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import json, re, time, transport, helpers
+from concurrent.futures import ThreadPoolExecutor
 
 instruments_link = 'https://api.etorostatic.com/sapi/app-data/web-client/app-data/instruments-groups.json'
 data_link = 'https://api.etorostatic.com/sapi/instrumentsmetadata/V1.1/instruments/bulk?bulkNumber=1&totalBulks=1'
@@ -11,6 +15,62 @@ instruments_by_display_name = None
 eur_exchange_suffixes = ['mi', 'pa']
 manual_mapping = {'UBSG/CHF': 'Szwajcaria', 'ANA/EUR': 'Hiszpania', 'LQDE/USD': 'Irlandia', 'IBE/EUR': 'Hiszpania'}
 etoro_cache = {}
+# raw algolia hits per query, persisted in the cache folder
+query_hits = None
+query_batch_size = 50
+query_workers = 4
+# compiled instruments are kept in the cache folder and revalidated with a conditional request once they get older than this
+instruments_index_version = 1
+instruments_max_age = int(os.environ.get('TAX_INSTRUMENTS_MAX_AGE', str(7 * 24 * 3600)))
+instrument_groups_snapshot = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instruments-groups.json')
+
+def query_hits_path():
+    return os.path.join(helpers.cache_dir, 'etoro_queries.json')
+
+def load_query_hits():
+    global query_hits
+    if query_hits is None:
+        query_hits = {}
+        if os.path.exists(query_hits_path()):
+            with open(query_hits_path(), 'r', encoding='utf-8') as f:
+                query_hits = json.load(f)
+    return query_hits
+
+def store_query_hits(hits):
+    load_query_hits().update(hits)
+    os.makedirs(helpers.cache_dir, exist_ok=True)
+    with open(query_hits_path() + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(query_hits, f)
+    os.replace(query_hits_path() + '.tmp', query_hits_path())
+
+def compact_hits(hits):
+    return [{'name': x['name'], 'symbolFull': x['symbolFull'], 'countryFull': x['countryFull']} for x in hits]
+
+def ask_etoro(query):
+    raw = '{"requests":[{"indexName":"prod_Instruments","query":"' + query + '","ruleContexts":["country_poland","remove_futures"],"params":"hitsPerPage=15&clickAnalytics=true"}]}'
+    r = transport.post(etoro_url, data=raw)
+    if r.status_code != 200:
+        raise Exception('failed query!')
+    return compact_hits(r.json()['results'][0]['hits'])
+
+def ask_etoro_batch(queries):
+    # algolia answers a list of queries in one request, results come back in the same order
+    raw = json.dumps({'requests': [{'indexName': 'prod_Instruments', 'query': query, 'ruleContexts': ['country_poland', 'remove_futures'], 'params': 'hitsPerPage=15&clickAnalytics=true'} for query in queries]})
+    r = transport.post(etoro_url, data=raw)
+    if r.status_code != 200:
+        raise Exception('failed query!')
+    return dict(zip(queries, [compact_hits(x['hits']) for x in r.json()['results']]))
+
+def prefetch_queries(queries):
+    missing = sorted(set([x for x in queries if x is not None and x not in load_query_hits()]))
+    if len(missing) == 0:
+        return
+    batches = [missing[i:i + query_batch_size] for i in range(0, len(missing), query_batch_size)]
+    hits = {}
+    with ThreadPoolExecutor(max_workers=query_workers) as executor:
+        for result in executor.map(ask_etoro_batch, batches):
+            hits.update(result)
+    store_query_hits(hits)
 
 def ask_etoro_cached(query, stock_symbol=None):
     if query in etoro_cache:
@@ -19,15 +79,29 @@ def ask_etoro_cached(query, stock_symbol=None):
     if stock_symbol is None:
         stock_symbol = query
 
-    raw = '{"requests":[{"indexName":"prod_Instruments","query":"' + query + '","ruleContexts":["country_poland","remove_futures"],"params":"hitsPerPage=15&clickAnalytics=true"}]}'
-    r = requests.post(etoro_url, data=raw)
-    if r.status_code != 200:
-        raise Exception('failed query!')
-    result = r.json()['results'][0]['hits']
+    if query not in load_query_hits():
+        store_query_hits({query: ask_etoro(query)})
+    result = query_hits[query]
     result_filtered = list([r['countryFull'] for r in result if r['name'].lower() == stock_symbol.lower() or r['symbolFull'].lower() == stock_symbol.lower()])
     etoro_cache[query] = result_filtered
     return result_filtered
 
+def prefetch_country_codes(stocks):
+    # collects the algolia queries of every (stock_name, stock_symbol) the instruments can't resolve and sends them in batches
+    load_instruments()
+    queries = []
+    for stock_name, stock_symbol in set(stocks):
+        if stock_symbol in manual_mapping:
+            continue
+        try:
+            countries, parsed_name, stock_symbol_parsed = match_instruments(stock_name, stock_symbol)
+        except Exception:
+            # get_country_code raises the same error later
+            continue
+        if len(countries) == 0:
+            queries += [parsed_name, stock_symbol_parsed]
+    prefetch_queries(queries)
+
 def get_country_code(stock_name, stock_symbol):
     load_instruments()
 
@@ -35,6 +109,23 @@ def get_country_code(stock_name, stock_symbol):
         return manual_mapping[stock_symbol]
 
     stock_symbol_original = stock_symbol
+    countries, stock_name, stock_symbol_parsed = match_instruments(stock_name, stock_symbol)
+    if len(countries) == 0:
+        countries_etoro = ask_etoro_cached(stock_name, stock_symbol_original)
+        if len(countries_etoro) == 0:
+            countries_etoro = ask_etoro_cached(stock_symbol_parsed)
+        countries = set([mapping[x] for x in countries_etoro if x != None and x != '' and x in mapping])
+        if len(countries) == 0 and len(countries_etoro) > 0:
+            raise Exception("Missing mapping for " + str(countries_etoro))
+    if len(countries) == 0:
+        raise Exception(f'Unknown country stock name: "{stock_name}" stock symbol: "{stock_symbol_original}"')
+
+    if len(countries) > 1:
+        raise Exception(f'More than one country "{stock_name}" and "{stock_symbol_original}" {countries}')
+
+    return countries.pop()
+
+def match_instruments(stock_name, stock_symbol):
     matched = []
     stock_symbol = None if stock_symbol is None else stock_symbol.lower().split(' ')[0].split('/')
     if stock_symbol is not None:
@@ -68,20 +159,7 @@ def get_country_code(stock_name, stock_symbol):
                 matched += instruments_by_full_symbol[stock_symbol_parsed]
 
     countries = set([x for x in map(get_country_code_from_match, matched) if x != None])
-    if len(countries) == 0:
-        countries_etoro = ask_etoro_cached(stock_name, stock_symbol_original)
-        if len(countries_etoro) == 0:
-            countries_etoro = ask_etoro_cached(stock_symbol_parsed)
-        countries = set([mapping[x] for x in countries_etoro if x != None and x != '' and x in mapping])
-        if len(countries) == 0 and len(countries_etoro) > 0:
-            raise Exception("Missing mapping for " + str(countries_etoro))
-    if len(countries) == 0:
-        raise Exception(f'Unknown country stock name: "{stock_name}" stock symbol: "{stock_symbol_original}"')
-
-    if len(countries) > 1:
-        raise Exception(f'More than one country "{stock_name}" and "{stock_symbol_original}" {countries}')
-
-    return countries.pop()
+    return (countries, stock_name, stock_symbol_parsed)
 
 def get_country_code_from_match(match):
     if match['InstrumentType'] == 'Cryptocurrencies':
@@ -98,42 +176,92 @@ def get_country_code_from_match(match):
 
     raise Exception(f'Missing mapping for {exchange}. SymbolName: {match["SymbolFull"]}')
 
-def load_instruments():
+def instruments_index_path():
+    return os.path.join(helpers.cache_dir, 'etoro_instruments.json')
+
+def load_instrument_groups(data):
+    # the bundled snapshot covers the known instrument types, the live file is only needed for a new type. bulk lists
+    # reference exchanges missing from ExchangeInfo all the time, those map to None like they always did
+    with open(instrument_groups_snapshot, 'r', encoding='utf-8') as f:
+        groups = json.load(f)
+    types = dict([(x['InstrumentTypeID'], x['InstrumentTypeDescription']) for x in groups['InstrumentTypes']])
+    exchanges = dict([(x['ExchangeID'], x['ExchangeDescription']) for x in groups['ExchangeInfo']])
+    if any(d['InstrumentTypeID'] not in types for d in data if not d['IsInternalInstrument']):
+        groups = transport.get(instruments_link).json()
+        types = dict([(x['InstrumentTypeID'], x['InstrumentTypeDescription']) for x in groups['InstrumentTypes']])
+        exchanges = dict([(x['ExchangeID'], x['ExchangeDescription']) for x in groups['ExchangeInfo']])
+    return (types, exchanges)
+
+def compile_instruments(data):
+    types, exchanges = load_instrument_groups(data)
+    all_instruments = []
+    for d in data:
+        # If the instrument is not available for the users, we don't need it
+        if d['IsInternalInstrument']:
+            continue
+
+        if d['InstrumentTypeID'] not in types:
+            raise Exception(f'Unknown instrument type {d["InstrumentTypeID"]} for {d["SymbolFull"]}')
+
+        # Sum up the gathered data
+        all_instruments.append({
+            'InstrumentDisplayName': d['InstrumentDisplayName'],
+            'SymbolFull': d['SymbolFull'],
+            'InstrumentType': types[d['InstrumentTypeID']],
+            'Exchange': exchanges.get(d['ExchangeID']),
+            'ExchangeId': d['ExchangeID']
+        })
+    return all_instruments
+
+def read_instruments_index():
+    path = instruments_index_path()
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    return index if index.get('version') == instruments_index_version else None
+
+def write_instruments_index(index):
+    os.makedirs(helpers.cache_dir, exist_ok=True)
+    path = instruments_index_path()
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+def download_instruments(index):
+    headers = {}
+    if index is not None and index.get('etag'):
+        headers['If-None-Match'] = index['etag']
+    if index is not None and index.get('last_modified'):
+        headers['If-Modified-Since'] = index['last_modified']
+
+    r = transport.get(data_link, headers=headers)
+    if r.status_code == 304 and index is not None:
+        index['timestamp'] = time.time()
+        return index
+    if r.status_code != 200:
+        raise Exception(f'Failed to download eToro instruments {r.status_code}')
+
+    response_headers = dict([(k.lower(), v) for k, v in r.headers.items()])
+    return {
+        'version': instruments_index_version,
+        'timestamp': time.time(),
+        'etag': response_headers.get('etag'),
+        'last_modified': response_headers.get('last-modified'),
+        'instruments': compile_instruments(r.json()['InstrumentDisplayDatas'])
+    }
+
+def load_instruments(refresh=False):
     global instruments_by_full_symbol
     global instruments_by_display_name
 
-    if instruments_by_full_symbol is None:
-        parsed_types = requests.get(instruments_link).json()
-        instruments = parsed_types['InstrumentTypes']
-        exchanges = parsed_types['ExchangeInfo']
-
-        data = requests.get(data_link).json()['InstrumentDisplayDatas']
-        all_instruments = []
-        for d in data:
-            # If the instrument is not available for the users, we don't need it
-            if d['IsInternalInstrument']:
-                continue
-
-            instrument_typeID = d['InstrumentTypeID']
-            name = d['InstrumentDisplayName']
-            exchangeID = d['ExchangeID']
-            symbol = d['SymbolFull']
-            instrument_type = next(item for item in instruments if item['InstrumentTypeID'] == instrument_typeID)['InstrumentTypeDescription']
-
-            try:
-                exchange = next(item for item in exchanges if item['ExchangeID'] == exchangeID)['ExchangeDescription']
-            except StopIteration:
-                exchange = None
-
-            # Sum up the gathered data
-            all_instruments.append({
-                'InstrumentDisplayName': name,
-                'SymbolFull': symbol,
-                'InstrumentType': instrument_type,
-                'Exchange': exchange,
-                'ExchangeId': exchangeID
-            })
+    if instruments_by_full_symbol is None or refresh:
+        index = read_instruments_index()
+        if refresh or index is None or time.time() - index['timestamp'] > instruments_max_age:
+            index = download_instruments(index)
+            write_instruments_index(index)
 
+        all_instruments = index['instruments']
         instruments_by_full_symbol = create_dict(all_instruments, lambda y: str(y['SymbolFull']).lower())
         instruments_by_display_name = create_dict(all_instruments, lambda y: str(y['InstrumentDisplayName']).lower())
 
@@ -184,4 +312,8 @@ mapping = {
     # 'fra': 'Niemcy',
     # 'cse': 'Kanada',
     # 'hel': 'Finlandia'
-}
\ No newline at end of file
+}
+
+if __name__ == '__main__':
+    load_instruments(refresh=True)
+    print(f'Stored {len(instruments_by_full_symbol)} instrument symbols in {instruments_index_path()}')
@@ -0,0 +1,80 @@
+import numpy as np
+from decimal import Decimal
+from helpers import get_rates_batch
+from money import rate_parts
+
+# numpy engine for the PLN conversions, amounts are int64 minor units and rounding is half to even like round(Decimal, 2)
+# the functions return None when the amounts don't fit in int64, the caller then falls back to the row loop
+product_limit = 2 ** 62
+
+def to_units(amounts):
+    # ints are cents already (fixed point mode), decimals are scaled to the most decimal places found, at least 2
+    if all(isinstance(x, int) for x in amounts):
+        return (list(amounts), 2)
+    places = max([2] + [-x.as_tuple().exponent for x in amounts])
+    return ([int(x.scaleb(places)) for x in amounts], places)
+
+def factor_columns(factors):
+    parts = [rate_parts(x) for x in factors]
+    denominator = max([d for _, d in parts])
+    return ([n * (denominator // d) for n, d in parts], denominator)
+
+def fits(values, numerators):
+    return max(map(abs, values)) * max(map(abs, numerators)) < product_limit
+
+def mul_round(values, numerators, denominator):
+    quotient, remainder = np.divmod(values * numerators, denominator)
+    return quotient + ((2 * remainder > denominator) | ((2 * remainder == denominator) & (quotient % 2 == 1)))
+
+def convert(dates, amounts, currency):
+    # PLN cents of rate * amount
+    units, places = to_units(amounts)
+    numerators, denominator = factor_columns(get_rates_batch(currency, dates))
+    if not fits(units, numerators):
+        return None
+    return mul_round(np.array(units, dtype=np.int64), np.array(numerators, dtype=np.int64), denominator * 10 ** (places - 2))
+
+def group_sum(groups, values, size):
+    result = np.zeros(size, dtype=np.int64)
+    np.add.at(result, groups, values)
+    return result
+
+def convert_positions(pending, countries, currency='USD'):
+    # returns (country, przychod, przychod rows, koszty, koszty rows) in the order of countries
+    kinds, row_countries, dates, amounts = zip(*pending)
+    pln = convert(dates, amounts, currency)
+    if pln is None:
+        return None
+
+    split = np.array([x == 'split' for x in kinds])
+    koszt = np.array([x == 'koszt' for x in kinds])
+    przychod = np.array([x == 'przychod' for x in kinds])
+    positive = pln > 0
+    przychod_mask = przychod | (split & positive)
+    koszty_mask = koszt | (split & ~positive)
+    przychod_values = np.where(przychod_mask, pln, 0)
+    koszty_values = np.where(koszt, pln, np.where(koszty_mask, -pln, 0))
+
+    index = dict([(country, idx) for idx, country in enumerate(countries)])
+    groups = np.array([index[x] for x in row_countries])
+    size = len(countries)
+    sums = [group_sum(groups, przychod_values, size), group_sum(groups, przychod_mask, size), group_sum(groups, koszty_values, size), group_sum(groups, koszty_mask, size)]
+    return [(country, *[int(x[idx]) for x in sums]) for idx, country in enumerate(countries)]
+
+def convert_dividends(pending, currency='USD'):
+    # returns (przychod, podatek nalezny, podatek zaplacony, any podatek zaplacony rows)
+    dates, amounts, nalezny_rates, zaplacony_rates = zip(*pending)
+    pln = convert(dates, amounts, currency)
+    if pln is None:
+        return None
+
+    paid = np.array([x is not None for x in zaplacony_rates])
+    nalezny_numerators, nalezny_denominator = factor_columns(nalezny_rates)
+    zaplacony_numerators, zaplacony_denominator = factor_columns([Decimal(0) if x is None else x for x in zaplacony_rates])
+    pln_values = [int(x) for x in pln]
+    if not fits(pln_values, nalezny_numerators) or not fits(pln_values, zaplacony_numerators):
+        return None
+
+    nalezny = mul_round(pln, np.array(nalezny_numerators, dtype=np.int64), nalezny_denominator)
+    zaplacony = np.where(paid, mul_round(pln, np.array(zaplacony_numerators, dtype=np.int64), zaplacony_denominator), 0)
+    return (int(pln.sum()), int(nalezny.sum()), int(zaplacony.sum()), bool(paid.any()))
@@ -1,71 +1,295 @@
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timezone
+from bisect import bisect_left, bisect_right
 from decimal import Decimal
 from dateutil import tz
-import requests, csv
+from concurrent.futures import ThreadPoolExecutor
+from openpyxl.worksheet._read_only import ReadOnlyWorksheet
+import csv, os, re, sys, mmap, sqlite3, threading, operator, importlib.util, transport, business_days
+from profiling import stage, count
 
 warsaw_timezone = tz.gettz('Europe/Warsaw')
 fiat_currencies = ['EUR', 'USD', 'GBP']
 rates_cache = {}
+rate_indexes = {}
+cache_dir = os.environ.get('TAX_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+rates_store = None
+# exchanges may run in threads, loading and downloading a rate table is done by one thread at a time
+rates_lock = threading.RLock()
+rates_store_version = 1 # part of the result cache key, bump when stored rates change meaning
+prefetch_workers = 8
+# 'rows' converts and rounds every row on its own (the declared figures), 'rates' sums the amounts per category,
+# currency and day, looks the rate up once per day and converts the sum of every rate once. far fewer conversions,
+# totals can differ by the per row rounding
+fx_aggregation = 'rows'
+
+def open_rates_store():
+    global rates_store
+    if rates_store is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        rates_store = sqlite3.connect(os.path.join(cache_dir, 'nbp_rates.sqlite'), check_same_thread=False)
+        rates_store.execute('CREATE TABLE IF NOT EXISTS tables (currency TEXT, year INTEGER, PRIMARY KEY (currency, year))')
+        rates_store.execute('CREATE TABLE IF NOT EXISTS rates (currency TEXT, year INTEGER, date TEXT, mid TEXT, PRIMARY KEY (currency, year, date))')
+    return rates_store
+
+def load_stored_rates(currency:str, year:int):
+    store = open_rates_store()
+    if store.execute('SELECT 1 FROM tables WHERE currency = ? AND year = ?', (currency, year)).fetchone() is None:
+        return None
+    rows = store.execute('SELECT date, mid FROM rates WHERE currency = ? AND year = ? ORDER BY date', (currency, year))
+    return dict([(datetime.strptime(day, '%Y-%m-%d').date(), Decimal(mid)) for day, mid in rows])
+
+def store_rates(currency:str, year:int, rates):
+    # the current year is still being published, keep it in memory only
+    if year >= datetime.now().year:
+        return
+    store = open_rates_store()
+    with store:
+        store.executemany('INSERT OR REPLACE INTO rates VALUES (?, ?, ?, ?)', [(currency, year, day.isoformat(), str(mid)) for day, mid in rates.items()])
+        store.execute('INSERT OR REPLACE INTO tables VALUES (?, ?)', (currency, year))
+
+def nbp_url(currency:str, year:int):
+    return f'https://api.nbp.pl/api/exchangerates/rates/A/{currency}/{year-1}-12-31/{year}-12-31?format=json'
+
+def download_rates(currency:str, year:int):
+    response = transport.get(nbp_url(currency, year)).json()
+    parse_date = lambda x: datetime.strptime(x, '%Y-%m-%d').date()
+    return dict([(parse_date(rate['effectiveDate']), Decimal(str(rate['mid']))) for rate in response['rates']])
 
 def fetch_rates(currency:str, year:int):
     global rates_cache
-    if year not in rates_cache:
-        rates_cache[year] = {}
+    rates_cache.setdefault(year, {})
 
     if currency not in rates_cache[year]:
-        response = requests.get(f'https://api.nbp.pl/api/exchangerates/rates/A/{currency}/{year-1}-12-31/{year}-12-31?format=json').json()
-        parse_date = lambda x: datetime.strptime(x, '%Y-%m-%d').date()
-        rates_cache[year][currency] = dict([(parse_date(rate['effectiveDate']), Decimal(str(rate['mid']))) for rate in response['rates']])
+        with rates_lock:
+            if currency not in rates_cache[year]:
+                rates = load_stored_rates(currency, year)
+                if rates is None:
+                    count('rate_store_misses')
+                    rates = download_rates(currency, year)
+                    store_rates(currency, year, rates)
+                else:
+                    count('rate_store_hits')
+                rates_cache[year][currency] = rates
+    else:
+        count('rates_cache_hits')
     return rates_cache[year][currency]
 
+def rate_tables_needed(dates, currency):
+    # get_rate falls back to the previous year's table for the first days of january
+    pairs = set()
+    if currency == 'PLN':
+        return pairs
+    for x in dates:
+        pairs.add((currency, x.year))
+        if x.month == 1 and x.day <= 7:
+            pairs.add((currency, x.year - 1))
+    return pairs
+
+def prefetch_rates(pairs):
+    with stage('fx_prefetch'), rates_lock:
+        missing = []
+        for currency, year in sorted(pairs):
+            if currency in rates_cache.get(year, {}):
+                count('rates_cache_hits')
+                continue
+            rates = load_stored_rates(currency, year)
+            if rates is None:
+                count('rate_store_misses')
+                missing.append((currency, year))
+            else:
+                count('rate_store_hits')
+                rates_cache.setdefault(year, {})[currency] = rates
+
+        with ThreadPoolExecutor(max_workers=prefetch_workers) as executor:
+            downloaded = list(executor.map(lambda x: download_rates(*x), missing))
+        for (currency, year), rates in zip(missing, downloaded):
+            store_rates(currency, year, rates)
+            rates_cache.setdefault(year, {})[currency] = rates
+
+def use_rates_snapshot(rates):
+    # a forked worker must not reuse the parent's sqlite connection
+    global rates_store
+    rates_store = None
+    rates_cache.update(rates)
+
+def get_rate_index(currency, year):
+    key = (currency, year)
+    if key not in rate_indexes:
+        rates = fetch_rates(currency, year)
+        days = sorted(rates)
+        rate_indexes[key] = (days, [rates[day] for day in days])
+    return rate_indexes[key]
+
+def find_rate(currency, asOfDate: date):
+    # last rate published within 6 days before asOfDate, otherwise the end of the previous year
+    count('fx_lookups')
+    days, values = get_rate_index(currency, asOfDate.year)
+    idx = bisect_left(days, asOfDate) - 1
+    if idx >= 0 and (asOfDate - days[idx]).days <= 6:
+        return values[idx]
+
+    asOfDate = date(asOfDate.year - 1, 12, 31)
+    days, values = get_rate_index(currency, asOfDate.year)
+    idx = bisect_right(days, asOfDate) - 1
+    if idx < 0 or (asOfDate - days[idx]).days > 5:
+        raise Exception(f"Failed to get rate for {asOfDate} and {currency}")
+    return values[idx]
+
 def get_rate(currency, asOfDate: datetime):
-    rates = fetch_rates(currency, asOfDate.year)
-    asOfDate = asOfDate.date()
-    asOfDates = [asOfDate - timedelta(days=i) for i in range(1, 7)]
-    rate =  next((rates[day] for day in asOfDates if day in rates), None)
-    if rate is None:
-        rates = fetch_rates(currency, asOfDate.year - 1)
-        asOfDate = datetime(asOfDate.year - 1, 12, 31).date()
-        asOfDates = [asOfDate - timedelta(days=i) for i in range(0, 6)]
-        rate =  next((rates[day] for day in asOfDates if day in rates), None)
-        if rate is None:
-            raise Exception(f"Failed to get rate for {asOfDate} and {currency}")
-
-    return rate
+    with stage('fx_lookup'):
+        return find_rate(currency, asOfDate.date())
+
+def get_rates_batch(currency, dates):
+    with stage('fx_lookup'):
+        days = [x.date() if isinstance(x, datetime) else x for x in dates]
+        resolved = dict([(day, find_rate(currency, day)) for day in sorted(set(days))])
+        return [resolved[day] for day in days]
 
 def convert_rate(asOfDate, amount, currency, dec_places = None) -> Decimal:
     return round(amount if currency == 'PLN' else (get_rate(currency, asOfDate) * amount), dec_places)
 
-def convert_sheet(sheet):
-    sheet.calculate_dimension()
-    cols = sheet.max_column
-    rows = sheet.max_row
-    header = [(sheet.cell(row=1, column=col_index).value, col_index) for col_index in range(1, cols + 1)]
-    get_row = lambda row: dict([(column, sheet.cell(row, col_index).value) for (column, col_index) in header])
-    return [get_row(idx) for idx in range(2, rows + 1)]
+def convert_rates_batch(dates, amounts, currency, dec_places = None):
+    if currency == 'PLN':
+        return [round(amount, dec_places) for amount in amounts]
+    return [round(rate * amount, dec_places) for rate, amount in zip(get_rates_batch(currency, dates), amounts)]
+
+class FxTotals:
+    # PLN totals per category, sign -1 subtracts the converted amount
+    def __init__(self, dec_places=None):
+        self.dec_places = dec_places
+        self.totals = {}
+        self.buckets = {}
 
-def read_csv(file_name):
-    transactions = []
+    def add(self, category, asOfDate, amount, currency, sign=1):
+        # returns the PLN amount of the row in 'rows' mode, None when it's only known per bucket
+        if fx_aggregation == 'rows':
+            pln = convert_rate(asOfDate, amount, currency, self.dec_places)
+            self.totals[category] = self.totals.get(category, Decimal(0)) + sign * pln
+            return pln
+        key = (category, currency, asOfDate.date())
+        self.buckets[key] = self.buckets.get(key, Decimal(0)) + sign * amount
+        return None
+
+    def add_many(self, category, dates, amounts, currency, sign=1):
+        if fx_aggregation == 'rows':
+            plns = convert_rates_batch(dates, amounts, currency, self.dec_places)
+            self.totals[category] = self.totals.get(category, Decimal(0)) + sign * sum(plns)
+            return
+        for asOfDate, amount in zip(dates, amounts):
+            self.add(category, asOfDate, amount, currency, sign)
+
+    def get(self, category):
+        if len(self.buckets) > 0:
+            # one rate lookup per day, the days published with the same rate are converted together
+            by_rate = {}
+            for (bucket_category, currency, day), amount in self.buckets.items():
+                key = (bucket_category, currency, find_rate(currency, day) if currency != 'PLN' else Decimal(1))
+                by_rate[key] = by_rate.get(key, Decimal(0)) + amount
+            for (bucket_category, currency, rate), amount in by_rate.items():
+                self.totals[bucket_category] = self.totals.get(bucket_category, Decimal(0)) + round(rate * amount, self.dec_places)
+            self.buckets = {}
+        return self.totals.get(category, Decimal(0))
+
+def iter_sheet_rows(sheet):
+    # read-only sheets stop at the declared dimension, which exporters don't always keep up to date
+    if isinstance(sheet, ReadOnlyWorksheet):
+        sheet.reset_dimensions()
+    rows = sheet.iter_rows(values_only=True)
+    header = dict([(column, idx) for idx, column in enumerate(next(rows, ()))])
+    return (header, rows)
+
+def iter_sheet(sheet, columns=None, predicate=None):
+    # columns prunes every row to the given columns, the ones missing in the sheet are left out.
+    # rows the predicate rejects are skipped before the caller does any parsing
+    header, rows = iter_sheet_rows(sheet)
+    columns = list(header.items()) if columns is None else [(column, header[column]) for column in columns if column in header]
+    parsed = 0
+    skipped = 0
+    for row in rows:
+        parsed += 1
+        pruned = dict([(column, row[idx] if idx < len(row) else None) for (column, idx) in columns])
+        if predicate is not None and not predicate(pruned):
+            skipped += 1
+            continue
+        yield pruned
+    count('rows_parsed', parsed)
+    count('rows_skipped', skipped)
+
+def record_lines(record):
+    # csv.reader wants the lines of a multi-line record one by one
+    text = record.decode('utf-8')
+    if '\n' not in text[:-1]:
+        return [text]
+    lines = text.split('\n')
+    return [x + '\n' for x in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+
+def prefiltered_lines(file_name, needles):
+    # the header, every line containing one of the needles (bytes) and every line with a quote, found with a regex over
+    # the memory mapped file. a line with unbalanced quotes is kept together with the next lines until they balance
+    if os.path.getsize(file_name) == 0:
+        return
+    with open(file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pattern = re.compile(b'|'.join([re.escape(x) for x in needles + [b'"']]))
+
+        def record_end(start):
+            end = data.find(b'\n', start) + 1 or len(data)
+            while data[start:end].count(b'"') % 2 == 1 and end < len(data):
+                end = data.find(b'\n', end) + 1 or len(data)
+            return end
+
+        pos = record_end(0)
+        yield from record_lines(data[0:pos])
+        while True:
+            match = pattern.search(data, pos)
+            if match is None:
+                break
+            start = data.rfind(b'\n', pos, match.start()) + 1 or pos
+            pos = record_end(start)
+            yield from record_lines(data[start:pos])
+
+def iter_csv(file_name, columns, needles=None):
+    # yields a tuple of the given columns per row without building the other fields, columns are looked up in the header once
+    # like csv.DictReader empty lines are skipped and fields missing at the end of a short row are None.
+    # needles turns on the prefilter, lines without any of them never reach the csv parser (see prefiltered_lines)
+    if needles is not None:
+        yield from iter_csv_lines(prefiltered_lines(file_name, needles), file_name, columns)
+        return
     with open(file_name, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            transactions.append(row)
+        yield from iter_csv_lines(f, file_name, columns)
 
-    return transactions
+def iter_csv_lines(lines, file_name, columns):
+    reader = csv.reader(lines)
+    header = dict([(column, idx) for idx, column in enumerate(next(reader, []))])
+    missing = [x for x in columns if x not in header]
+    if len(missing) > 0:
+        raise Exception(f'Missing columns {missing} in {file_name}')
+    indexes = [header[x] for x in columns]
+    width = max(indexes) + 1
+    getter = operator.itemgetter(*indexes) if len(indexes) > 1 else lambda row: (row[indexes[0]],)
+    parsed = 0
+    for row in reader:
+        if len(row) == 0:
+            continue
+        parsed += 1
+        yield getter(row) if len(row) >= width else tuple([row[idx] if idx < len(row) else None for idx in indexes])
+    count('rows_parsed', parsed)
 
 def sum_dict(d):
     return sum([v for k,v in d.items()])
 
-def add_working_days(date, d):
-    business_days_to_add = d
-    current_date = date
-    while business_days_to_add > 0:
-        current_date += timedelta(days=1)
-        weekday = current_date.weekday()
-        if weekday >= 5: # sunday = 6
-            continue
-        business_days_to_add -= 1
-    return current_date
+def add_working_days(date, d, calendar='weekdays'):
+    return business_days.add(date, d, calendar)
 
 def from_utc_to_warsaw(dt: datetime):
-    return dt.replace(tzinfo=timezone.utc).astimezone(tz=warsaw_timezone)
\ No newline at end of file
+    return dt.replace(tzinfo=timezone.utc).astimezone(tz=warsaw_timezone)
+
+def load_script(path, name):
+    # calculators live in scripts with clashing names (calculate_tax.py), load them by path under a unique name
+    path = os.path.abspath(path)
+    folder = os.path.dirname(path)
+    if folder not in sys.path:
+        sys.path.append(folder)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -1,4 +1,5 @@
-import os, traceback
+import os, sys, traceback
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from datetime import datetime, tzinfo
 from typing import Iterable, List, NamedTuple
 from azure.devops.v6_0.git.models import GitPullRequest
@@ -11,6 +12,7 @@ from openpyxl.styles import Font, Fill
 import pytz
 from az import get_my_prs_from_repos, get_my_work_items_ids
 from settings import excel_path, year, from_month, to_month, projects
+from profiling import stage, count
 import re
 
 insensitive = re.compile('fix:?', re.IGNORECASE)
@@ -92,11 +94,17 @@ for month in range(from_month, to_month + 1):
     try:
         excel_models = []
         for project in projects:
-            prs = list(get_my_prs_from_repos(start_date, end_date, project))
-            work_items = list(get_my_work_items_ids(prs, start_date, end_date, project))
-            excel_models += build_excel_models(work_items, prs)
-
-        write_excel(excel_models, month)
+            with stage('azure_prs'):
+                prs = list(get_my_prs_from_repos(start_date, end_date, project))
+            with stage('azure_work_items'):
+                work_items = list(get_my_work_items_ids(prs, start_date, end_date, project))
+            count('prs', len(prs))
+            count('work_items', len(work_items))
+            with stage('excel_models'):
+                excel_models += build_excel_models(work_items, prs)
+
+        with stage('excel_write'):
+            write_excel(excel_models, month)
         print(f"Created {month}")
     except Exception:
         print(f"Failed on month {month}")
@@ -4,7 +4,9 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from openpyxl import load_workbook
 from datetime import datetime
 from decimal import Decimal
-from helpers import convert_rate, convert_sheet
+from helpers import FxTotals, iter_sheet, prefetch_rates, rate_tables_needed
+from profiling import stage, count
+import helpers, result_cache
 import re
 
 income_types = ["Interest received", "Interest received from loan repurchase", "Late fees received", "Delayed interest income on transit rebuy", "Interest received from pending payments",]
@@ -26,56 +28,82 @@ def parse_isin_loan(text):
     return None
 
 def process_transactions(path):
-    workbook = load_workbook(filename=path, read_only=False)
+    with stage('workbook_load'):
+        workbook = load_workbook(filename=path, read_only=True)
     transactions = dict()
-    withloding_taxes = Decimal('0')
-
-    for s in workbook.sheetnames:
-
-        sheet = convert_sheet(workbook[s])
-        for row in sheet:
-            if row['Date'] is None:
-                continue
-            trans_type = row['Payment Type']
-            date = datetime.strptime(row['Date'], '%Y-%m-%d %H:%M:%S')
-            amount = Decimal(str(row["Turnover"]))
-            isin_loan = parse_isin_loan(row['Details'])
-            if isin_loan not in transactions:
-                transactions[isin_loan] = []
-
-            trans_group = transactions[isin_loan]
-            exiting_trans = next((x for x in trans_group if x['date'] == date), None)
-            if trans_type in income_types:
-                if exiting_trans is not None:
-                    exiting_trans['amount'] += amount
+    taxes = []
+
+    # exit() on an unknown type raises SystemExit, the workbook is closed either way. a half read sheet keeps the file
+    # open even after the workbook is closed
+    sheet = None
+    try:
+        for s in workbook.sheetnames:
+
+            sheet = iter_sheet(workbook[s])
+            for row in sheet:
+                if row['Date'] is None:
+                    count('rows_skipped')
+                    continue
+                trans_type = row['Payment Type']
+                date = datetime.strptime(row['Date'], '%Y-%m-%d %H:%M:%S')
+                amount = Decimal(str(row["Turnover"]))
+                isin_loan = parse_isin_loan(row['Details'])
+                if isin_loan not in transactions:
+                    transactions[isin_loan] = []
+
+                trans_group = transactions[isin_loan]
+                exiting_trans = next((x for x in trans_group if x['date'] == date), None)
+                if trans_type in income_types:
+                    if exiting_trans is not None:
+                        exiting_trans['amount'] += amount
+                    else:
+                        trans_group.append({'isin_loan': isin_loan, 'type': 'profit', 'subtype': trans_type, 'date': date, 'amount': amount, 'currency': row['Currency']})
+                elif trans_type == 'Tax withholding':
+                    taxes.append({'date': date, 'amount': amount, 'currency': row['Currency']})
+                elif trans_type in cost_types:
+                    trans_group.append({'isin_loan': isin_loan, 'type': 'fee', 'date': date, 'amount': amount, 'currency':  row['Currency']})
+                elif trans_type in ignored_typed:
+                    count('rows_skipped')
+                    continue
                 else:
-                    trans_group.append({'isin_loan': isin_loan, 'type': 'profit', 'subtype': trans_type, 'date': date, 'amount': amount, 'currency': row['Currency']})
-            elif trans_type == 'Tax withholding':
-                withloding_taxes += convert_rate(date, amount, row['Currency'], 2)
-            elif trans_type in cost_types:
-                trans_group.append({'isin_loan': isin_loan, 'type': 'fee', 'date': date, 'amount': amount, 'currency':  row['Currency']})
-            elif trans_type in ignored_typed:
-                continue
-            else:
-                print(f"Unknown transaction type {trans_type}")
-                exit(1)
-
-    return [item for row in transactions.values() for item in row], withloding_taxes
+                    print(f"Unknown transaction type {trans_type}")
+                    exit(1)
+    finally:
+        if sheet is not None:
+            sheet.close()
+        workbook.close()
+    transactions = [item for row in transactions.values() for item in row]
+    prefetch_rates(set([pair for x in transactions + taxes for pair in rate_tables_needed([x['date']], x['currency'])]))
+    fx = FxTotals(2)
+    for currency in set([x['currency'] for x in taxes]):
+        group = [x for x in taxes if x['currency'] == currency]
+        fx.add_many('tax', [x['date'] for x in group], [x['amount'] for x in group], currency)
+
+    return transactions, fx.get('tax')
 
 
 def calculate_tax(path):
+    settings = {'witholding_tax': str(witholding_tax), 'polish_tax': str(polish_tax), 'fx_aggregation': helpers.fx_aggregation}
+    return result_cache.cached('mintos', [path], settings, lambda: calculate_statement(path))
+
+def calculate_statement(path):
     przychod = Decimal("0")
     cost = Decimal("0")
     total_tax = Decimal('0')
 
-    transactions, withloding_taxes = process_transactions(path)
-    for trans in transactions:
-        if trans['type'] == 'profit':
-            przychod += convert_rate(trans['date'], trans['amount'], trans['currency'], 2)
-        elif trans['type'] == 'fee':
-            cost += convert_rate(trans['date'], trans['amount'], trans['currency'], 2)
-        else:
+    with stage('parse'):
+        transactions, withloding_taxes = process_transactions(path)
+
+    with stage('aggregation'):
+        if any(x['type'] not in ['profit', 'fee'] for x in transactions):
             raise Exception('wtf')
+        fx = FxTotals(2)
+        for currency in set([x['currency'] for x in transactions]):
+            for trans_type in ['profit', 'fee']:
+                group = [x for x in transactions if x['currency'] == currency and x['type'] == trans_type]
+                fx.add_many(trans_type, [x['date'] for x in group], [x['amount'] for x in group], currency)
+        przychod += fx.get('profit')
+        cost += fx.get('fee')
 
     total_tax = round(total_tax, 2)
     przychod = round(przychod, 2)
@@ -88,12 +116,16 @@ def calculate_tax(path):
 
     return przychod, dochod, cost, total_tax, tax_paid_abroad, tax_to_pay
 
-przychod, dochod, cost, total_tax, tax_paid_abroad, tax_to_pay = calculate_tax('mintos.xlsx')
+def main(path):
+    przychod, dochod, cost, total_tax, tax_paid_abroad, tax_to_pay = calculate_tax(path)
+
+    print("Mintos rozliczamy w PIT-38!")
+    print(f"Przychód w pln: {przychod} zł")
+    print(f"Dochód w pln: {dochod} zł")
+    print(f"Koszt w pln: {cost} zł")
+    print(f"Podatek łącznie: {total_tax} zł")
+    print(f"Podatek zaplacony: {tax_paid_abroad} zł")
+    print(f"Podatek do zapłacenia: {tax_to_pay} zł  TO WPISUJEMY DO PITA")
 
-print("Mintos rozliczamy w PIT-38!")
-print(f"Przychód w pln: {przychod} zł")
-print(f"Dochód w pln: {dochod} zł")
-print(f"Koszt w pln: {cost} zł")
-print(f"Podatek łącznie: {total_tax} zł")
-print(f"Podatek zaplacony: {tax_paid_abroad} zł")
-print(f"Podatek do zapłacenia: {tax_to_pay} zł  TO WPISUJEMY DO PITA") 
\ No newline at end of file
+if __name__ == '__main__':
+    main('mintos.xlsx')
\ No newline at end of file
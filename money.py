@@ -0,0 +1,44 @@
+from decimal import Decimal
+from helpers import get_rate
+
+# amounts kept as int minor units (cents/grosze), rounding matches round(Decimal, n) which is half to even
+rate_parts_cache = {}
+
+class SubCentAmount(Exception):
+    # int cents can't hold the amount, the caller has to use Decimals
+    pass
+
+def parse_cents(r) -> int:
+    value = Decimal(str(r)).scaleb(2)
+    if value != value.to_integral_value():
+        raise SubCentAmount(f'Amount {r} has more than 2 decimal places')
+    return int(value)
+
+def to_decimal(cents) -> Decimal:
+    return Decimal(cents).scaleb(-2)
+
+def rate_parts(rate: Decimal):
+    if rate not in rate_parts_cache:
+        places = max(-rate.as_tuple().exponent, 0)
+        rate_parts_cache[rate] = (int(rate.scaleb(places)), 10 ** places)
+    return rate_parts_cache[rate]
+
+def round_div(numerator: int, denominator: int) -> int:
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+def mul_round(cents: int, factor: Decimal) -> int:
+    # same as round(factor * amount, 2)
+    numerator, denominator = rate_parts(factor)
+    return round_div(cents * numerator, denominator)
+
+def round_units(cents: int) -> int:
+    # same as round(amount)
+    return round_div(cents, 100)
+
+def convert_cents(asOfDate, cents: int, currency) -> int:
+    if currency == 'PLN':
+        return cents
+    return mul_round(cents, get_rate(currency, asOfDate))
@@ -0,0 +1,66 @@
+import os, json, time, atexit
+from contextlib import nullcontext
+
+# TAX_PROFILE=report.json turns on stage timings and counters, the report is written when the process exits
+report_path = os.environ.get('TAX_PROFILE')
+enabled = bool(report_path)
+stages = {}
+counters = {}
+disabled_stage = nullcontext()
+
+class Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        seconds, calls = stages.get(self.name, (0.0, 0))
+        stages[self.name] = (seconds + time.perf_counter() - self.start, calls + 1)
+
+def stage(name):
+    # stages nest, so the time of an inner stage is also part of the outer one
+    return Stage(name) if enabled else disabled_stage
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+def run_staged(name, func, *args):
+    # for worker processes, the stages and counters recorded by func go back to the parent with its result
+    stages.clear()
+    counters.clear()
+    with stage(name):
+        result = func(*args)
+    return result, dict(stages), dict(counters)
+
+def merge(worker_stages, worker_counters):
+    for name, (seconds, calls) in worker_stages.items():
+        total, total_calls = stages.get(name, (0.0, 0))
+        stages[name] = (total + seconds, total_calls + calls)
+    for name, n in worker_counters.items():
+        count(name, n)
+
+def report():
+    return {
+        'stages': dict([(name, {'seconds': round(seconds, 6), 'calls': calls}) for name, (seconds, calls) in stages.items()]),
+        'counters': dict(counters)
+    }
+
+def dump(path=None):
+    path = path or report_path
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report(), f, indent=2)
+
+def enable(path):
+    global enabled, report_path
+    if not enabled:
+        atexit.register(dump)
+    enabled = True
+    report_path = path
+
+if enabled:
+    atexit.register(dump)
@@ -0,0 +1,58 @@
+import os, pickle, hashlib
+import helpers
+from profiling import count
+
+# TAX_RESULT_CACHE=1 stores the figures of whole calculator runs in the cache folder. the key covers the input files,
+# the settings, the rate store version and the source of every script, so an unchanged statement is returned at once
+enabled = os.environ.get('TAX_RESULT_CACHE', '0') == '1'
+root = os.path.dirname(os.path.abspath(__file__))
+code_hash = None
+excluded_dirs = ['__pycache__', 'benchmarks', 'venv']
+
+def hash_file(digest, path):
+    if not os.path.exists(path):
+        digest.update(b'missing')
+        return
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+def code_version():
+    global code_hash
+    if code_hash is None:
+        digest = hashlib.sha256()
+        # pruning dirs in place keeps the walk out of benchmarks, caches and virtualenvs inside the checkout
+        for folder, dirs, files in os.walk(root):
+            dirs[:] = sorted([x for x in dirs if not x.startswith('.') and x not in excluded_dirs])
+            for name in sorted([x for x in files if x.endswith('.py')]):
+                path = os.path.join(folder, name)
+                digest.update(os.path.relpath(path, root).encode('utf-8'))
+                hash_file(digest, path)
+        code_hash = digest.hexdigest()
+    return code_hash
+
+def cache_key(name, paths, settings):
+    digest = hashlib.sha256()
+    digest.update(repr((name, sorted(settings.items()), helpers.rates_store_version, code_version())).encode('utf-8'))
+    for path in paths:
+        digest.update(b'\0')
+        hash_file(digest, path)
+    return digest.hexdigest()
+
+def cached(name, paths, settings, compute):
+    # failed runs are not stored, they are computed again and raise the same errors
+    if not enabled:
+        return compute()
+    path = os.path.join(helpers.cache_dir, 'results', f'{name}-{cache_key(name, paths, settings)}.pickle')
+    if os.path.exists(path):
+        count('result_cache_hits')
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    count('result_cache_misses')
+    result = compute()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(result, f)
+    os.replace(path + '.tmp', path)
+    return result
@@ -0,0 +1,45 @@
+import os, sys, re, shutil, zipfile, tempfile, unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from openpyxl import Workbook, load_workbook
+import helpers
+
+def write_stale_workbook(path, rows):
+    # the sheet declares A1:B3 like exports that append rows without updating <dimension>
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['a', 'b', 'c'])
+    for idx in range(rows):
+        sheet.append([idx, idx * 2, idx * 3])
+    workbook.save(path + '.tmp')
+    with zipfile.ZipFile(path + '.tmp') as source, zipfile.ZipFile(path, 'w') as target:
+        for item in source.infolist():
+            data = source.read(item.filename)
+            if item.filename == 'xl/worksheets/sheet1.xml':
+                data = re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="A1:B3"', data)
+            target.writestr(item, data)
+    os.remove(path + '.tmp')
+
+class IterSheetTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'stale.xlsx')
+        write_stale_workbook(self.path, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_read_only_sheet_ignores_stale_dimension(self):
+        workbook = load_workbook(filename=self.path, read_only=True)
+        rows = list(helpers.iter_sheet(workbook[workbook.sheetnames[0]]))
+        workbook.close()
+        self.assertEqual(rows, [{'a': idx, 'b': idx * 2, 'c': idx * 3} for idx in range(10)])
+
+    def test_columns_beyond_stale_dimension(self):
+        workbook = load_workbook(filename=self.path, read_only=True)
+        rows = list(helpers.iter_sheet(workbook[workbook.sheetnames[0]], ['c'], lambda row: row['c'] > 21))
+        workbook.close()
+        self.assertEqual(rows, [{'c': 24}, {'c': 27}])
+
+if __name__ == '__main__':
+    unittest.main()
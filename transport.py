@@ -0,0 +1,105 @@
+import os, sys, json, time, hashlib
+import requests
+from profiling import stage, count
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# live: talk to the real services, record: live + save every response as a fixture,
+# replay: serve fixtures in process, stub: send requests to a local stub server (python transport.py serve)
+http_mode = os.environ.get('TAX_HTTP_MODE', 'live')
+fixtures_dir = os.environ.get('TAX_HTTP_FIXTURES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'http'))
+latency = float(os.environ.get('TAX_HTTP_LATENCY', '0'))
+stub_url = os.environ.get('TAX_HTTP_STUB', 'http://127.0.0.1:8765')
+original_url_header = 'X-Original-Url'
+
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+class FixtureResponse:
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.text)
+
+def fixture_path(method, url, data):
+    key = f'{method.upper()} {url}\n{data or ""}'
+    return os.path.join(fixtures_dir, method.lower() + '-' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+def load_fixture(method, url, data):
+    path = fixture_path(method, url, data)
+    if not os.path.exists(path):
+        raise Exception(f'Missing HTTP fixture for {method} {url}')
+    with open(path, 'r', encoding='utf-8') as f:
+        fixture = json.load(f)
+    return FixtureResponse(fixture['status_code'], fixture['body'], fixture['headers'])
+
+def write_fixture(method, url, data, status_code, headers, body):
+    os.makedirs(fixtures_dir, exist_ok=True)
+    fixture = {'method': method, 'url': url, 'data': data, 'status_code': status_code, 'headers': headers, 'body': body}
+    with open(fixture_path(method, url, data), 'w', encoding='utf-8') as f:
+        json.dump(fixture, f)
+
+def save_fixture(method, url, data, response):
+    write_fixture(method, url, data, response.status_code, dict(response.headers), response.text)
+
+def request(method, url, data=None, headers=None):
+    count('http_requests')
+    with stage('http'):
+        if http_mode == 'replay':
+            if latency > 0:
+                time.sleep(latency)
+            return load_fixture(method, url, data)
+        if http_mode == 'stub':
+            return session.request(method, stub_url, data=data, headers={**(headers or {}), original_url_header: url})
+
+        response = session.request(method, url, data=data, headers=headers)
+        if http_mode == 'record':
+            save_fixture(method, url, data, response)
+        return response
+
+def get(url, headers=None):
+    return request('GET', url, headers=headers)
+
+def post(url, data=None, headers=None):
+    return request('POST', url, data=data, headers=headers)
+
+class StubHandler(BaseHTTPRequestHandler):
+    def respond(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length).decode('utf-8') if length > 0 else None
+        try:
+            fixture = load_fixture(method, self.headers[original_url_header], data)
+        except Exception as e:
+            self.send_error(404, str(e))
+            return
+
+        if latency > 0:
+            time.sleep(latency)
+        body = fixture.text.encode('utf-8')
+        self.send_response(fixture.status_code)
+        self.send_header('Content-Type', fixture.headers.get('Content-Type', 'application/json'))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port):
+    print(f'Serving fixtures from {fixtures_dir} on port {port} with {latency}s latency')
+    ThreadingHTTPServer(('127.0.0.1', port), StubHandler).serve_forever()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'serve':
+        print('usage: python transport.py serve [port]')
+        exit(1)
+    serve(int(sys.argv[2]) if len(sys.argv) > 2 else 8765)